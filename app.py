@@ -1,23 +1,62 @@
 import os
+import re
+import sys
+import io
+import json
+import random
+import gzip
+import time
+import asyncio
 import uvicorn
 import numpy as np
-import tempfile
 import gdown
 import sqlite3
-import tensorflow as tf
-import random
-from datetime import datetime
+import argparse
+import functools
+import struct
+import uuid
+import itertools
+import queue
+import threading
+import hashlib
+import hmac
+import secrets
+import signal
+import weakref
+import warnings
+import contextvars
+import collections
+import bisect
+import zipfile
+import tarfile
+from collections import OrderedDict
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional
+from xml.sax.saxutils import escape
 from PIL import Image
-from fastapi import FastAPI, UploadFile, File, Body
+from fastapi import FastAPI, UploadFile, File, Form, Body, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.formparsers import MultiPartParser
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # --- REPORTLAB IMPORTS FOR PROFESSIONAL PDF ---
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import inch, mm
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as RLImage
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Image as RLImage
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.graphics.shapes import Drawing, Rect, String
 from reportlab.graphics.charts.barcharts import VerticalBarChart
@@ -25,11 +64,14 @@ from reportlab.graphics.charts.barcharts import VerticalBarChart
 # ==========================================
 # 1. DATABASE SETUP (SQLite)
 # ==========================================
-DB_NAME = "deepgyn_records.db"
+DB_NAME = os.environ.get("DEEPGYN_DB", "deepgyn_records.db")
+DB_POOL_SIZE = int(os.environ.get("DEEPGYN_DB_POOL_SIZE", "4"))
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
+def init_db(path=DB_NAME):
+    conn = sqlite3.connect(path)
     c = conn.cursor()
+    # WAL is stored in the file: readers no longer block the writer and vice versa
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute('''
         CREATE TABLE IF NOT EXISTS scans (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -43,9 +85,348 @@ def init_db():
         )
     ''')
     conn.commit()
+    migrate(conn)
     conn.close()
 
-init_db()
+# --- Schema Migrations ---
+# Applied in order at startup; PRAGMA user_version records how many have run,
+# so each step runs exactly once per database file. A step is either a SQL
+# statement or a function taking the connection. Long data rewrites are only
+# queued by their step (see deferred) and run after startup on a background
+# thread, so a large legacy database doesn't hold up the server. They commit in
+# MIGRATION_BATCH_SIZE slices so the write lock is only held briefly, other
+# workers can keep saving scans, and an interrupted run resumes where it stopped.
+# Until they finish, date-filtered queries and /analytics can miss older scans.
+MIGRATION_BATCH_SIZE = int(os.environ.get("DEEPGYN_MIGRATION_BATCH_SIZE", "5000"))
+
+def add_column(table, column, decl):
+    def step(conn):
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return step
+
+def backfill_created_at(conn):
+    # timestamp holds local wall-clock text; the 'utc' modifier converts it to UTC
+    lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM scans").fetchone()
+    if lo is None:
+        return
+    for start in range(lo, hi + 1, MIGRATION_BATCH_SIZE):
+        conn.execute("UPDATE scans SET created_at = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) "
+                     "WHERE id >= ? AND id < ? AND created_at IS NULL", (start, start + MIGRATION_BATCH_SIZE))
+        conn.commit()
+
+# --- Analytics Summary ---
+# scan_stats holds per (day, doctor, location, category, confidence decile)
+# counts, kept current by triggers on scans, so /analytics reads a few hundred
+# summary rows instead of aggregating the raw table. Existing rows are folded in
+# by a resumable backfill up to the id recorded when the triggers were created.
+def stats_key(ref):
+    return (f"date({ref}created_at, 'unixepoch', 'localtime')",
+            f"COALESCE({ref}doctor_email, '')",
+            f"COALESCE({ref}location, '')",
+            f"COALESCE({ref}prediction, '')",
+            f"MAX(0, MIN(CAST(COALESCE({ref}confidence, 0) * 10 AS INTEGER), 9))")
+
+STATS_UPSERT = ("ON CONFLICT (day, doctor_email, location, prediction, bucket) DO UPDATE SET "
+                "count = count + excluded.count, confidence_sum = confidence_sum + excluded.confidence_sum")
+
+def create_scan_stats(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scan_stats (
+            day TEXT NOT NULL,
+            doctor_email TEXT NOT NULL,
+            location TEXT NOT NULL,
+            prediction TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            confidence_sum REAL NOT NULL,
+            PRIMARY KEY (day, doctor_email, location, prediction, bucket)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_stats_doctor ON scan_stats (doctor_email, day)")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_scans_stats_insert AFTER INSERT ON scans
+        WHEN NEW.created_at IS NOT NULL
+        BEGIN
+            INSERT INTO scan_stats VALUES ({', '.join(stats_key('NEW.'))}, 1, COALESCE(NEW.confidence, 0))
+            {STATS_UPSERT};
+        END
+    """)
+    old_key = stats_key("OLD.")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_scans_stats_delete AFTER DELETE ON scans
+        WHEN OLD.created_at IS NOT NULL
+        BEGIN
+            UPDATE scan_stats SET count = count - 1, confidence_sum = confidence_sum - COALESCE(OLD.confidence, 0)
+            WHERE day = {old_key[0]} AND doctor_email = {old_key[1]} AND location = {old_key[2]}
+              AND prediction = {old_key[3]} AND bucket = {old_key[4]};
+        END
+    """)
+    # Rows up to target_id predate the triggers and are counted by the backfill
+    conn.execute("CREATE TABLE IF NOT EXISTS scan_stats_backfill (through_id INTEGER NOT NULL, target_id INTEGER NOT NULL)")
+    if conn.execute("SELECT COUNT(*) FROM scan_stats_backfill").fetchone()[0] == 0:
+        conn.execute("INSERT INTO scan_stats_backfill SELECT 0, COALESCE(MAX(id), 0) FROM scans")
+    conn.commit()
+
+def backfill_scan_stats(conn):
+    # Each slice re-reads the watermark inside its own write transaction, so
+    # concurrent workers never count the same id range twice
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        through, target = conn.execute("SELECT through_id, target_id FROM scan_stats_backfill").fetchone()
+        if through >= target:
+            conn.commit()
+            return
+        upper = min(through + MIGRATION_BATCH_SIZE, target)
+        conn.execute(f"""
+            INSERT INTO scan_stats
+            SELECT {', '.join(stats_key(''))}, COUNT(*), SUM(COALESCE(confidence, 0)) FROM scans
+            WHERE id > ? AND id <= ? AND created_at IS NOT NULL
+            GROUP BY 1, 2, 3, 4, 5
+            {STATS_UPSERT}
+        """, (through, upper))
+        conn.execute("UPDATE scan_stats_backfill SET through_id = ? WHERE through_id = ?", (upper, through))
+        conn.commit()
+
+BACKFILLS = {"created_at": backfill_created_at, "scan_stats": backfill_scan_stats}
+
+def deferred(backfill):
+    def step(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS pending_backfills (name TEXT PRIMARY KEY)")
+        conn.execute("INSERT OR IGNORE INTO pending_backfills VALUES (?)", (backfill,))
+    return step
+
+MIGRATIONS = [
+    ("index scans by doctor and id", "CREATE INDEX IF NOT EXISTS idx_scans_doctor_id ON scans (doctor_email, id)"),
+    ("add integer epoch created_at", add_column("scans", "created_at", "INTEGER")),
+    ("backfill created_at from timestamp", deferred("created_at")),
+    ("index scans by doctor and created_at", "CREATE INDEX IF NOT EXISTS idx_scans_doctor_created ON scans (doctor_email, created_at)"),
+    ("index scans by created_at", "CREATE INDEX IF NOT EXISTS idx_scans_created ON scans (created_at)"),
+    ("create scan_stats summary and triggers", create_scan_stats),
+    ("backfill scan_stats", deferred("scan_stats")),
+    ("add class probabilities to scans", add_column("scans", "details", "TEXT")),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+@contextmanager
+def migration_lock(conn):
+    # Every worker runs init_db at startup; an exclusive lock on a file next to
+    # the database lets exactly one of them apply each pending step
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    if not path:
+        yield
+        return
+    with open(f"{path}.migrate-lock", "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def migrate(conn):
+    with migration_lock(conn):
+        while (version := schema_version(conn)) < len(MIGRATIONS):
+            apply_migration(conn, version + 1, *MIGRATIONS[version])
+
+def apply_migration(conn, number, name, step):
+    started = time.perf_counter()
+    if callable(step):
+        step(conn)
+    else:
+        conn.execute(step)
+    conn.execute(f"PRAGMA user_version = {number}")
+    conn.commit()
+    print(f"✅ Applied schema migration {number} ({name}) in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def run_backfills(path=DB_NAME):
+    # Queued in migration order, which scan_stats relies on: it only counts rows
+    # whose created_at is already filled in. Every worker runs this; the
+    # backfills are idempotent slice by slice, so overlapping runs are harmless.
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'pending_backfills'").fetchone() is None:
+            return
+        for (name,) in conn.execute("SELECT name FROM pending_backfills ORDER BY rowid").fetchall():
+            started = time.perf_counter()
+            BACKFILLS[name](conn)
+            conn.execute("DELETE FROM pending_backfills WHERE name = ?", (name,))
+            conn.commit()
+            print(f"✅ Finished {name} backfill in {(time.perf_counter() - started) * 1000:.0f} ms")
+    except Exception as e:
+        print(f"❌ Backfill failed, will resume on next start: {e}")
+    finally:
+        conn.close()
+
+# --- Connection Pool ---
+# DB work runs on a small dedicated thread pool, off the event loop. Each pool
+# thread keeps one long-lived connection, so the pragmas are set once and
+# sqlite3's per-connection statement cache keeps the INSERT/SELECT prepared.
+class ConnectionPool:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = max(1, size)
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="sqlite")
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # check_same_thread=False only so close() can run from the loop thread
+        conn = sqlite3.connect(self.path, timeout=10, cached_statements=256, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")      # durable across app crashes, fsync only at checkpoints
+        conn.execute("PRAGMA cache_size=-16384")       # 16 MB page cache
+        conn.execute("PRAGMA mmap_size=268435456")     # 256 MB memory-mapped reads
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def call(self, fn, *args):
+        conn = self.connection()
+        started = time.perf_counter()
+        try:
+            return fn(conn, *args)
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            db_latency.observe(elapsed, fn.__name__)
+            note_stage(f"db_{fn.__name__}", elapsed)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        # run_in_executor drops contextvars; carry them so stage timings reach the request
+        return await loop.run_in_executor(self.executor, contextvars.copy_context().run, self.call, fn, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        # Leave the pool usable again, e.g. when the app is started a second time
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="sqlite")
+        self.local = threading.local()
+
+db = ConnectionPool(DB_NAME, DB_POOL_SIZE)
+
+def scan_row(doctor_email, name, age, location, prediction, confidence, created_at, details=None):
+    # timestamp stays as display text for existing clients; created_at is what gets queried
+    timestamp = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S")
+    return (doctor_email, name, age, location, prediction, confidence, timestamp, int(created_at),
+            json.dumps(details) if details else None)
+
+def insert_scans(conn, rows):
+    # One transaction (and one commit/fsync) for the whole batch
+    ids = [conn.execute("INSERT INTO scans (doctor_email, name, age, location, prediction, confidence, timestamp, created_at, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        row).lastrowid for row in rows]
+    with stage_timer("sqlite_commit"):
+        conn.commit()
+    return ids
+
+def insert_scan(conn, doctor_email, name, age, location, prediction, confidence, created_at):
+    return insert_scans(conn, [scan_row(doctor_email, name, age, location, prediction, confidence, created_at)])[0]
+
+HISTORY_COLUMNS = ("id", "doctor_email", "name", "age", "location", "prediction", "confidence", "timestamp", "created_at")
+
+def day_start(day):
+    return int(datetime.combine(day, datetime.min.time()).timestamp())
+
+ANALYTICS_DIMENSIONS = ("doctor_email", "location", "prediction", "day")
+CONFIDENCE_BUCKETS = 10
+
+def fetch_analytics(conn, dimensions, filters, start=None, end=None):
+    where, params = [], []
+    for column, value in filters.items():
+        where.append(f"{column} = ?")
+        params.append(value)
+    if start is not None:
+        where.append("day >= ?")
+        params.append(start.isoformat())
+    if end is not None:
+        where.append("day <= ?")
+        params.append(end.isoformat())
+    group = ", ".join([*dimensions, "bucket"])
+    sql = (f"SELECT {group}, SUM(count), SUM(confidence_sum) FROM scan_stats"
+           f"{' WHERE ' + ' AND '.join(where) if where else ''} GROUP BY {group} HAVING SUM(count) > 0 ORDER BY {group}")
+
+    groups = {}
+    for row in conn.execute(sql, params):
+        key = tuple(row[:len(dimensions)])
+        bucket, count, confidence_sum = row[len(dimensions):]
+        entry = groups.get(key)
+        if entry is None:
+            entry = groups[key] = {**dict(zip(dimensions, key)), "scans": 0, "confidence_sum": 0.0,
+                                   "confidence_histogram": [0] * CONFIDENCE_BUCKETS}
+        entry["scans"] += count
+        entry["confidence_sum"] += confidence_sum
+        entry["confidence_histogram"][bucket] += count
+    for entry in groups.values():
+        entry["mean_confidence"] = entry.pop("confidence_sum") / entry["scans"]
+    return list(groups.values())
+
+def scan_filter(email, start=None, end=None):
+    where, params = ["doctor_email = ?"], [email]
+    if start is not None:
+        where.append("created_at >= ?")
+        params.append(day_start(start))
+    if end is not None:
+        where.append("created_at < ?")
+        params.append(day_start(end + timedelta(days=1)))
+    return " AND ".join(where), params
+
+def count_scans(conn, email, start=None, end=None):
+    where, params = scan_filter(email, start, end)
+    return conn.execute(f"SELECT COUNT(*) FROM scans WHERE {where}", params).fetchone()[0]
+
+def fetch_export_page(conn, email, after_id, start=None, end=None, limit=500):
+    # Oldest first, keyset on id so an export of any size reads fixed-size pages
+    where, params = scan_filter(email, start, end)
+    rows = conn.execute(f"SELECT id, name, age, location, prediction, confidence, details, timestamp FROM scans "
+                        f"WHERE {where} AND id > ? ORDER BY id LIMIT ?", [*params, after_id, limit]).fetchall()
+    return [dict(row) for row in rows]
+
+def iter_export_rows(conn, email, start=None, end=None):
+    after_id = 0
+    while rows := fetch_export_page(conn, email, after_id, start, end):
+        yield from rows
+        after_id = rows[-1]["id"]
+
+def fetch_history(conn, email, limit=None, before_id=None, columns=HISTORY_COLUMNS, start=None, end=None):
+    # Walks idx_scans_doctor_id backwards from before_id, so the cost depends on
+    # the page size rather than on how many scans the doctor has
+    sql = f"SELECT {', '.join(columns)} FROM scans WHERE doctor_email = ?"
+    params = [email]
+    if before_id is not None:
+        sql += " AND id < ?"
+        params.append(before_id)
+    if start is not None:
+        sql += " AND created_at >= ?"
+        params.append(day_start(start))
+    if end is not None:
+        sql += " AND created_at < ?"
+        params.append(day_start(end + timedelta(days=1)))
+    sql += " ORDER BY id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [dict(row) for row in conn.execute(sql, params).fetchall()]
 
 # ==========================================
 # 2. FRONTEND CODE (Unchanged)
@@ -302,6 +683,7 @@ html_content = """
                         </tbody>
                     </table>
                 </div>
+                <button class="btn btn-email" id="loadMoreBtn">Load More</button>
             </div>
         </section>
 
@@ -468,6 +850,7 @@ html_content = """
     <script>
         const BASE_URL = ""; 
         let currentResultData = null; 
+        let lastReport = null;
 
         function previewImage(input) {
             const preview = document.getElementById('img-preview');
@@ -515,8 +898,18 @@ html_content = """
             const formData = new FormData();
             formData.append("file", document.getElementById('pFile').files[0]);
 
+            // Logged-in doctors get inference and the record insert in one request
+            const saving = !!window.currentUserEmail;
+            if(saving) {
+                formData.append("name", document.getElementById('pName').value);
+                formData.append("age", document.getElementById('pAge').value);
+                formData.append("location", document.getElementById('pLoc').value);
+                formData.append("doctor_email", window.currentUserEmail);
+            }
+
             try {
-                const response = await fetch(`${BASE_URL}/predict`, { method: 'POST', body: formData });
+                const endpoint = saving ? "predict-and-save" : "predict";
+                const response = await fetch(`${BASE_URL}/${endpoint}`, { method: 'POST', body: formData });
                 if (!response.ok) throw new Error("Backend connection failed");
                 const data = await response.json();
                 
@@ -529,22 +922,6 @@ html_content = """
                     patientLocation: document.getElementById('pLoc').value
                 };
 
-                // Save with User Email
-                if(window.currentUserEmail) {
-                    await fetch(`${BASE_URL}/save-scan`, {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({
-                            doctor_email: window.currentUserEmail, 
-                            name: currentResultData.patientName,
-                            age: currentResultData.patientAge,
-                            location: currentResultData.patientLocation,
-                            prediction: currentResultData.prediction,
-                            confidence: currentResultData.confidence
-                        })
-                    });
-                }
-
                 showResults(data);
 
             } catch (error) {
@@ -610,12 +987,16 @@ html_content = """
             const btn = document.getElementById('downloadBtn');
             btn.innerText = "Generating PDF...";
             try {
+                const headers = { 'Content-Type': 'application/json' };
+                if(lastReport) headers['If-None-Match'] = lastReport.etag;
                 const response = await fetch(`${BASE_URL}/generate-report`, {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
+                    headers: headers,
                     body: JSON.stringify(currentResultData)
                 });
-                const blob = await response.blob();
+                // 304: same report as last time, reuse the PDF we already have
+                const blob = response.status === 304 ? lastReport.blob : await response.blob();
+                if(response.headers.get('ETag')) lastReport = { etag: response.headers.get('ETag'), blob: blob };
                 const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.style.display = 'none'; a.href = url;
@@ -628,15 +1009,21 @@ html_content = """
             }
         });
 
-        async function loadHistory() {
+        async function loadHistory(beforeId) {
             if(!window.currentUserEmail) return;
-            // Send email as query param to filter history
-            const res = await fetch(`${BASE_URL}/history?email=${encodeURIComponent(window.currentUserEmail)}`);
+            // Send email as query param to filter history; beforeId fetches the next page
+            let url = `${BASE_URL}/history?email=${encodeURIComponent(window.currentUserEmail)}`;
+            if(beforeId) url += `&before_id=${beforeId}`;
+            const res = await fetch(url);
             const data = await res.json();
             const tbody = document.getElementById('history-table-body');
-            tbody.innerHTML = "";
-            
-            if(data.history.length === 0) {
+            if(!beforeId) tbody.innerHTML = "";
+
+            const moreBtn = document.getElementById('loadMoreBtn');
+            window.historyBeforeId = data.next_before_id;
+            moreBtn.style.display = data.next_before_id ? "block" : "none";
+
+            if(!beforeId && data.history.length === 0) {
                 tbody.innerHTML = "<tr><td colspan='5' style='text-align:center; color:#888;'>No records found for your account.</td></tr>";
                 return;
             }
@@ -657,16 +1044,374 @@ html_content = """
                 tbody.appendChild(tr);
             });
         }
+
+        document.getElementById('loadMoreBtn').addEventListener('click', () => loadHistory(window.historyBeforeId));
     </script>
 </body>
 </html>
 """
 
+# The page is static, so every encoding is built once at import and GET /
+# just picks one. Each representation gets its own strong ETag (RFC 9110
+# requires them to differ per Content-Encoding).
+def build_frontend_variants(html):
+    body = html.encode("utf-8")
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {encoding: (data, f'"{digest}-{encoding}"') for encoding, data in variants.items()}
+
+frontend_variants = build_frontend_variants(html_content)
+
+def negotiate_encoding(accept_encoding, available):
+    # Any acceptable compressed encoding beats identity; among them the
+    # highest q wins, ties going to the smaller one (br, then gzip)
+    weights = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = "identity", 0.0
+    for encoding in ("br", "gzip"):
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if encoding in available and q > 0 and q > best_q:
+            best, best_q = encoding, q
+    return best
+
 # ==========================================
 # 3. BACKEND LOGIC
 # ==========================================
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Phase 1 is cheap and synchronous; the model is loaded in phase 2 without
+    # holding up the server, see load_model()
+    init_db()
+    threading.Thread(target=run_backfills, name="backfill", daemon=True).start()
+    threading.Thread(target=load_model, name="model-loader", daemon=True).start()
+    warm_report_pool()
+    scheduler.start()
+    writer.start()
+    yield
+    await scheduler.close()
+    await writer.close()
+    if isinstance(backend, RemoteBackend):
+        backend.close()
+    db.close()
+
+# --- Upload Limits ---
+# Image uploads are bounded before anything is decoded:
+#   - request bodies on the upload routes are capped (MAX_UPLOAD_BYTES per
+#     single-image request, MAX_BATCH_UPLOAD_BYTES for /predict-batch and
+#     /predict-stream); a Content-Length over the cap gets a 413 before the
+#     body is read, and a chunked body is cut off once it crosses it
+#   - multipart file parts stay in memory up to UPLOAD_SPOOL_BYTES and spill
+#     to a temp file beyond that, and are then read in UPLOAD_CHUNK_BYTES steps
+#   - the format is sniffed from the first bytes (415 if not an allowed image)
+#     and PIL is only allowed to use that decoder
+#   - images over MAX_IMAGE_PIXELS are refused from their header (413), and
+#     anything PIL can't decode is a 400
+MAX_UPLOAD_BYTES = int(os.environ.get("DEEPGYN_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_BATCH_UPLOAD_BYTES = int(os.environ.get("DEEPGYN_MAX_BATCH_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get("DEEPGYN_MAX_IMAGE_PIXELS", str(64_000_000)))
+UPLOAD_SPOOL_BYTES = int(os.environ.get("DEEPGYN_UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+FORM_OVERHEAD_BYTES = 64 * 1024  # multipart boundaries and the /predict-and-save text fields
+
+UPLOAD_LIMITS = {
+    "/predict": MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES,
+    "/predict-and-save": MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES,
+    "/predict-batch": MAX_BATCH_UPLOAD_BYTES,
+    "/predict-stream": MAX_BATCH_UPLOAD_BYTES,
+}
+
+IMAGE_SIGNATURES = [
+    ("JPEG", (b"\xff\xd8\xff",)),
+    ("PNG", (b"\x89PNG\r\n\x1a\n",)),
+    ("TIFF", (b"II*\x00", b"MM\x00*")),
+    ("BMP", (b"BM",)),
+    ("GIF", (b"GIF87a", b"GIF89a")),
+]
+
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_BYTES
+# PIL's own bomb check as a backstop; open_image refuses these first, so its warning is just noise
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+
+class UploadRejected(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def sniff_image_format(head):
+    for fmt, signatures in IMAGE_SIGNATURES:
+        if head.startswith(signatures):
+            return fmt
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+def open_image(fp):
+    head = fp.read(16)
+    fp.seek(-len(head), 1)
+    fmt = sniff_image_format(head)
+    if fmt is None:
+        raise UploadRejected(415, "Unsupported file type; upload a JPEG, PNG, TIFF, BMP, GIF or WebP image.")
+    try:
+        img = Image.open(fp, formats=[fmt])
+    except Image.DecompressionBombError as e:
+        raise UploadRejected(413, str(e))
+    except (Image.UnidentifiedImageError, OSError, SyntaxError, ValueError) as e:
+        raise UploadRejected(400, f"Could not read {fmt} image: {e}")
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise UploadRejected(413, f"Image is {width}x{height}; the limit is {MAX_IMAGE_PIXELS} pixels.")
+    return img
+
+def hash_upload(fp):
+    # Streams the (possibly spooled-to-disk) upload once: SHA-256 for the
+    # prediction cache, plus the size check for bodies that had no Content-Length
+    digest = hashlib.sha256()
+    size = 0
+    fp.seek(0)
+    while chunk := fp.read(UPLOAD_CHUNK_BYTES):
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise UploadRejected(413, f"Upload exceeds {MAX_UPLOAD_BYTES} bytes.")
+        digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+class UploadLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def reject(self, send, limit):
+        body = json.dumps({"error": f"Request body exceeds {limit} bytes."}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        limit = UPLOAD_LIMITS.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                return await self.reject(send, limit)
+
+        # No (or a lying) Content-Length: count the bytes as they arrive and
+        # swap whatever the app answers for a 413 once the cap is crossed
+        received = 0
+        exceeded = responded = False
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal responded
+            if not exceeded:
+                return await send(message)
+            if not responded:
+                responded = True
+                await self.reject(send, limit)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not responded:
+            await self.reject(send, limit)
+
+# --- Metrics ---
+# Prometheus text-format metrics on GET /metrics, without a client library:
+#   deepgyn_http_requests_total / deepgyn_http_request_seconds by route and status
+#   deepgyn_stage_seconds   time spent in each step of a request (upload read,
+#                           decode, resize, model predict, serialization, SQLite
+#                           commit, ReportLab build, ...)
+#   deepgyn_db_seconds      every ConnectionPool job, by function
+#   gauges for in-flight requests and the depth of each queue/pool, read at
+#   scrape time
+# Recording is a perf_counter pair plus a bisect under a lock, cheap enough to
+# leave on; DEEPGYN_METRICS=0 turns it off entirely.
+METRICS_ENABLED = os.environ.get("DEEPGYN_METRICS", "1") == "1"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        lines += [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+        return lines
+
+class Gauge:
+    # Either set()/inc() directly, or backed by a callback evaluated per scrape
+    def __init__(self, name, help, labelnames=(), collect=None):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.collect = collect
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels):
+        self.inc(*labels, amount=-1)
+
+    def expose(self):
+        values = self.collect() if self.collect else self.values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in sorted(values.items())]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((labels, ([*counts], total, count)) for labels, (counts, total, count) in self.series.items())
+        names = (*self.labelnames, "le")
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{format_labels(names, (*labels, bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+http_requests = Counter("deepgyn_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+http_latency = Histogram("deepgyn_http_request_seconds", "HTTP request latency by route.", ("route", "method"))
+http_in_flight = Gauge("deepgyn_http_requests_in_flight", "HTTP requests currently being handled.")
+stage_latency = Histogram("deepgyn_stage_seconds", "Time spent in each processing stage.", ("stage",))
+db_latency = Histogram("deepgyn_db_seconds", "Time spent in connection pool jobs, by function.", ("op",))
+batch_sizes = Histogram("deepgyn_inference_batch_size", "Images per model call.", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+# Per-request stage totals for the slow-request log. Set by ProfilingMiddleware;
+# None (and free) for requests nobody is watching.
+request_stages = contextvars.ContextVar("request_stages", default=None)
+
+def note_stage(stage, seconds):
+    stages = request_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+def observe_stage(stage, seconds):
+    stage_latency.observe(seconds, stage)
+    note_stage(stage, seconds)
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+def queue_depths():
+    # Read at scrape time; all of these live in later sections
+    depths = {("inference_slots",): inference.pending, ("report_slots",): reports.pending,
+              ("export_jobs",): sum(job["status"] in ("queued", "running") for job in export_jobs.values())}
+    if scheduler.queue is not None:
+        depths[("batch_queue",)] = scheduler.queue.qsize()
+    if writer.queue is not None:
+        depths[("write_behind_queue",)] = writer.queue.qsize()
+    return depths
+
+queue_depth = Gauge("deepgyn_queue_depth", "Work admitted but not yet finished, per queue.", ("queue",), collect=queue_depths)
+all_metrics = (http_requests, http_latency, http_in_flight, stage_latency, db_latency, batch_sizes, queue_depth)
+
+class MetricsMiddleware:
+    # Plain ASGI rather than @app.middleware("http"), which wraps every
+    # request in an extra task and buffers streaming responses
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec()
+            # The route template, not the raw path, to keep label cardinality bounded
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_latency.observe(time.perf_counter() - started, path, scope["method"])
+            http_requests.inc(path, scope["method"], status)
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content):
+        started = time.perf_counter()
+        body = super().render(content)
+        observe_stage("json_serialize", time.perf_counter() - started)
+        return body
+
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -676,22 +1421,243 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compresses JSON bodies (e.g. large /history pages) above the threshold. PDFs,
+# zips and the NDJSON stream are left alone; GET / negotiates its own encoding.
+GZIP_MIN_BYTES = int(os.environ.get("DEEPGYN_GZIP_MIN_BYTES", "1024"))
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=GZIP_MIN_BYTES,
+    compresslevel=6,
+    exclude_content_types=("text/html", "application/pdf", "application/zip", "application/x-ndjson", "image/*"),
+)
+
+app.add_middleware(UploadLimitMiddleware)
+
+@app.exception_handler(UploadRejected)
+async def upload_rejected_handler(request, exc):
+    return JSONResponse(status_code=exc.status_code, content={"error": str(exc)})
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# --- Request Profiling ---
+# Opt-in sampling profiler for finding what a slow request is stuck in
+# (TensorFlow, PIL, ReportLab, SQLite, ...). A request is profiled when
+#   - it is one of the DEEPGYN_PROFILE_SAMPLE_RATE fraction picked at random, or
+#   - it carries "X-DeepGyn-Profile: <DEEPGYN_PROFILE_TOKEN>" (ignored unless a
+#     token is configured).
+# While a profiled request runs, a background thread snapshots every Python
+# thread's stack each PROFILE_INTERVAL_MS (the event loop, the inference and
+# SQLite pools), skipping idle ones. Stacks are merged per route into
+# PROFILE_DIR/<route>.folded in collapsed-stack format ("a;b;c count"), ready
+# for flamegraph.pl or speedscope. Samples cover everything running at the
+# time, not just the profiled request, and report workers are separate
+# processes, so ReportLab shows up only as report_build in the stage totals.
+#
+# Independently, any request slower than DEEPGYN_SLOW_REQUEST_MS is appended
+# to PROFILE_DIR/slow_requests.jsonl with its per-stage time breakdown. Past
+# SLOW_LOG_BYTES the log is rotated to slow_requests.jsonl.1 (one old file kept).
+PROFILE_SAMPLE_RATE = float(os.environ.get("DEEPGYN_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.environ.get("DEEPGYN_PROFILE_TOKEN", "")
+PROFILE_INTERVAL_MS = float(os.environ.get("DEEPGYN_PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("DEEPGYN_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+SLOW_REQUEST_MS = float(os.environ.get("DEEPGYN_SLOW_REQUEST_MS", "0"))
+SLOW_LOG_BYTES = int(os.environ.get("DEEPGYN_SLOW_LOG_BYTES", str(10 * 1024 * 1024)))
+
+# Leaf frames of threads that are just waiting for work
+IDLE_FRAMES = {("selectors.py", "select"), ("thread.py", "_worker"), ("threading.py", "wait"),
+               ("queue.py", "get"), ("connection.py", "_poll"), ("connection.py", "accept")}
+
+class StackSampler:
+    def __init__(self, interval_ms, max_depth=96):
+        self.interval = max(0.001, interval_ms / 1000.0)
+        self.max_depth = max_depth
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        # The thread only runs while at least one profiled request is in flight
+        samples = collections.Counter()
+        with self.lock:
+            self.active[id(samples)] = samples
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self.thread.start()
+        return samples
+
+    def stop(self, samples):
+        with self.lock:
+            self.active.pop(id(samples), None)
+
+    def stack(self, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+            return None
+        parts = []
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                targets = list(self.active.values())
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self.stack(frame)
+                if stack is not None:
+                    stacks.append(f"{names.get(ident, ident)};{stack}")
+            for samples in targets:
+                samples.update(stacks)
+
+sampler = StackSampler(PROFILE_INTERVAL_MS)
+route_profiles = {}
+route_profiles_lock = threading.Lock()
+
+def route_slug(path):
+    return "".join(c if c.isalnum() else "_" for c in path.strip("/")) or "root"
+
+def save_profile(route, samples):
+    with route_profiles_lock:
+        merged = route_profiles.setdefault(route, collections.Counter())
+        merged.update(samples)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{route_slug(route)}.folded")
+        with open(path + ".tmp", "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in merged.most_common())
+        os.replace(path + ".tmp", path)
+
+slow_log_lock = threading.Lock()
+
+def log_slow_request(entry):
+    path = os.path.join(PROFILE_DIR, "slow_requests.jsonl")
+    with slow_log_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) >= SLOW_LOG_BYTES:
+            os.replace(path, path + ".1")
+        with open(path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+def wants_profile(scope):
+    if PROFILE_TOKEN:
+        for name, value in scope["headers"]:
+            if name == b"x-deepgyn-profile":
+                return hmac.compare_digest(value, PROFILE_TOKEN.encode())
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        samples = sampler.start() if wants_profile(scope) else None
+        stages = {}
+        token = request_stages.set(stages)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            request_stages.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            if samples is not None:
+                sampler.stop(samples)
+                await asyncio.to_thread(save_profile, path, samples)
+            if SLOW_REQUEST_MS and elapsed_ms >= SLOW_REQUEST_MS:
+                breakdown = {stage: round(seconds * 1000, 2) for stage, seconds in stages.items()}
+                print(f"🐢 Slow request {scope['method']} {scope['path']}: {elapsed_ms:.0f} ms {breakdown}")
+                await asyncio.to_thread(log_slow_request, {
+                    "time": datetime.now().isoformat(timespec="seconds"), "method": scope["method"], "route": path,
+                    "path": scope["path"], "elapsed_ms": round(elapsed_ms, 2), "stages_ms": breakdown,
+                    "profiled": samples is not None})
+
+if PROFILE_SAMPLE_RATE > 0 or PROFILE_TOKEN or SLOW_REQUEST_MS > 0:
+    app.add_middleware(ProfilingMiddleware)
+
+
 # --- Model Loading ---
+# Downloading the model, importing TensorFlow, loading the .h5 and a warm-up
+# pass all run on a background thread, so uvicorn starts serving GET / at once.
+# /readyz turns 200 once the model is loaded and warmed; until then the
+# inference endpoints answer 503.
 MODEL_DIR = os.path.join(os.path.dirname(__file__), "model")
-MODEL_PATH = os.path.join(MODEL_DIR, "cnn_model.h5")
+MODEL_PATH = os.environ.get("DEEPGYN_MODEL_PATH", os.path.join(MODEL_DIR, "cnn_model.h5"))
+MODEL_URL = "https://drive.google.com/uc?id=1L84L6Wiy9_SCLjgdPvnBgoQH8VRCsG4v"
 os.makedirs(MODEL_DIR, exist_ok=True)
 
-if not os.path.exists(MODEL_PATH):
-    print("📥 Model not found. Downloading...")
-    url = "https://drive.google.com/uc?id=1L84L6Wiy9_SCLjgdPvnBgoQH8VRCsG4v"
-    gdown.download(url, MODEL_PATH, quiet=False)
+tf = None
+model = None
+backend = None
+model_state = {"status": "starting", "error": None, "phases": {}, "version": None}
+
+def model_file_version(path):
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+def load_model():
+    global tf, model, backend
+    model_state["status"] = "loading"
+    phases = model_state["phases"]
+    if INFERENCE_SERVERS:
+        return connect_inference_servers()
+    try:
+        started = time.perf_counter()
+        if not os.path.exists(MODEL_PATH):
+            print("📥 Model not found. Downloading...")
+            gdown.download(MODEL_URL, MODEL_PATH, quiet=False)
+        phases["download_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        started = time.perf_counter()
+        import tensorflow
+        tf = tensorflow
+        phases["import_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        started = time.perf_counter()
+        # Taken before reading the file, so a model swapped in later never
+        # shares cache entries with the one actually being served
+        version = model_file_version(MODEL_PATH)
+        loaded = tf.keras.models.load_model(MODEL_PATH)
+        print(f"✅ Model loaded from {MODEL_PATH}")
+        try:
+            selected = load_backend(INFERENCE_BACKEND, loaded, version=version)
+            print(f"✅ Using {selected.name} inference backend")
+        except Exception as e:
+            print(f"❌ Failed to build {INFERENCE_BACKEND} backend, falling back to keras: {e}")
+            selected = KerasBackend(loaded)
+        phases["load_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        # Trace every batch bucket the scheduler and bulk endpoints can produce
+        started = time.perf_counter()
+        size = 1
+        while size <= batch_bucket(max(BATCH_MAX_SIZE, PREDICT_BATCH_SIZE)):
+            selected.predict(np.zeros((size, *INPUT_SHAPE), dtype=np.float32))
+            size *= 2
+        phases["warmup_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        model, backend = loaded, selected
+        model_state.update(status="ready", version=version)
+        print(f"✅ Model ready ({selected.name}): {phases}")
+    except Exception as e:
+        print(f"❌ Failed to load model: {e}")
+        model_state.update(status="failed", error=str(e))
 
-try:
-    model = tf.keras.models.load_model(MODEL_PATH)
-    print(f"✅ Model loaded from {MODEL_PATH}")
-except Exception as e:
-    print(f"❌ Failed to load model: {e}")
-    model = None
+def model_unavailable():
+    return JSONResponse(status_code=503, content={"error": "Model not loaded.", "status": model_state["status"]},
+                        headers={"Retry-After": "5"})
 
 # --- Constants ---
 classes = ["im_Dyskeratotic", "im_Koilocytotic", "im_Metaplastic", "im_Parabasal", "im_Superficial-Intermediate"]
@@ -703,6 +1669,921 @@ category_map = {
     "im_Superficial-Intermediate": "Normal"
 }
 
+# --- Image Preprocessing ---
+# Decodes uploads straight into the model's input layout. JPEG draft mode lets
+# libjpeg decode large micrographs at 1/2..1/8 scale, the mode is normalized to
+# RGB (RGBA/grayscale/palette uploads), and the scaled pixels are written in a
+# single pass into a float32 buffer that batch callers can preallocate.
+INPUT_SIZE = (224, 224)
+INPUT_SHAPE = (224, 224, 3)
+
+def decode_image(fp, size=INPUT_SIZE):
+    started = time.perf_counter()
+    img = open_image(fp)
+    img.draft("RGB", size)
+    try:
+        img.load()  # decode here rather than lazily inside resize, so the stages split cleanly
+    except (OSError, SyntaxError, ValueError) as e:
+        raise UploadRejected(400, f"Could not decode image: {e}")
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    observe_stage("image_decode", time.perf_counter() - started)
+    return img
+
+def resize_into(img, size, out):
+    np.multiply(np.asarray(img.resize(size, Image.BICUBIC, reducing_gap=3.0)), np.float32(1 / 255.0),
+                out=out, dtype=np.float32)
+    return out
+
+def preprocess_image(fp, out=None):
+    img = decode_image(fp)
+    started = time.perf_counter()
+    if out is None:
+        out = np.empty(INPUT_SHAPE, dtype=np.float32)
+    resize_into(img, INPUT_SIZE, out)
+    observe_stage("image_resize", time.perf_counter() - started)
+    return out
+
+# --- Inference Backends ---
+# Interchangeable ways of running the same cnn_model.h5, picked with
+# DEEPGYN_INFERENCE_BACKEND:
+#   keras  - eager model.predict (original behaviour)
+#   xla    - tf.function with a fixed input signature, compiled with XLA
+#   tflite - TFLite conversion of the .h5; DEEPGYN_TFLITE_QUANTIZATION may be
+#            "none", "float16" or "int8" (dynamic-range int8 weights)
+# Compiled backends pad each batch up to a power-of-two bucket so only a
+# handful of shapes are ever traced/allocated. TFLite conversions are cached
+# next to the .h5 as cnn_model.<quantization>.<h5 version>.tflite.
+INFERENCE_BACKEND = os.environ.get("DEEPGYN_INFERENCE_BACKEND", "keras").lower()
+TFLITE_QUANTIZATION = os.environ.get("DEEPGYN_TFLITE_QUANTIZATION", "none").lower()
+TFLITE_THREADS = int(os.environ.get("DEEPGYN_TFLITE_THREADS", str(os.cpu_count() or 1)))
+
+def batch_bucket(n):
+    return 1 << max(0, n - 1).bit_length()
+
+def pad_batch(batch):
+    size = batch_bucket(len(batch))
+    if size == len(batch):
+        return batch
+    padded = np.zeros((size, *batch.shape[1:]), dtype=np.float32)
+    padded[:len(batch)] = batch
+    return padded
+
+class KerasBackend:
+    name = "keras"
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, batch):
+        return self.model.predict(batch, verbose=0)
+
+class XLABackend:
+    name = "xla"
+
+    def __init__(self, model):
+        self.fn = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec([None, *INPUT_SHAPE], tf.float32)],
+            jit_compile=True,
+        )
+
+    def predict(self, batch):
+        return self.fn(tf.constant(pad_batch(batch))).numpy()[:len(batch)]
+
+class TFLiteBackend:
+    name = "tflite"
+
+    def __init__(self, model, quantization, cache_path=None, save=True):
+        self.quantization = quantization
+        self.content = self.load_or_convert(model, quantization, cache_path, save)
+        # Interpreters aren't thread-safe, keep one per batch bucket behind a lock
+        self.interpreters = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load_or_convert(model, quantization, cache_path, save):
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return f.read()
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        if quantization == "float16":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == "int8":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        elif quantization != "none":
+            raise ValueError(f"Unknown TFLite quantization '{quantization}'")
+        content = converter.convert()
+        if cache_path and save:
+            # Other workers may be reading the cache: publish it whole with a rename
+            tmp = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, cache_path)
+            remove_stale_tflite(cache_path, quantization)
+            print(f"✅ Converted model to {cache_path}")
+        return content
+
+    def interpreter(self, size):
+        interpreter = self.interpreters.get(size)
+        if interpreter is None:
+            try:
+                from ai_edge_litert.interpreter import Interpreter
+            except ImportError:
+                Interpreter = tf.lite.Interpreter
+            interpreter = Interpreter(model_content=self.content, num_threads=TFLITE_THREADS)
+            interpreter.resize_tensor_input(interpreter.get_input_details()[0]["index"], [size, *INPUT_SHAPE])
+            interpreter.allocate_tensors()
+            self.interpreters[size] = interpreter
+        return interpreter
+
+    def predict(self, batch):
+        padded = pad_batch(batch)
+        with self.lock:
+            interpreter = self.interpreter(len(padded))
+            interpreter.set_tensor(interpreter.get_input_details()[0]["index"], padded)
+            interpreter.invoke()
+            return interpreter.get_tensor(interpreter.get_output_details()[0]["index"])[:len(batch)].copy()
+
+def tflite_cache_path(quantization, version):
+    return os.path.splitext(MODEL_PATH)[0] + f".{quantization}.{version}.tflite"
+
+def remove_stale_tflite(current, quantization):
+    # Conversions of earlier .h5 versions can never be used again
+    directory, prefix = os.path.split(os.path.splitext(MODEL_PATH)[0] + f".{quantization}.")
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(prefix) and name.endswith(".tflite") and path != current:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def load_backend(name, model, quantization=TFLITE_QUANTIZATION, version=None, save=True):
+    # version is the loaded .h5's model_file_version(); without it nothing is cached
+    if name == "keras":
+        return KerasBackend(model)
+    if name == "xla":
+        return XLABackend(model)
+    if name == "tflite":
+        return TFLiteBackend(model, quantization, tflite_cache_path(quantization, version) if version else None, save)
+    raise ValueError(f"Unknown inference backend '{name}'")
+
+def check_backend_parity(image_dir):
+    # Runs every backend over the reference images and compares predicted classes
+    paths = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir) if is_image_entry(f))
+    if not paths:
+        raise ValueError(f"No reference images found in {image_dir}")
+    batch = np.empty((len(paths), *INPUT_SHAPE), dtype=np.float32)
+    for i, path in enumerate(paths):
+        with open(path, "rb") as fp:
+            preprocess_image(fp, batch[i])
+
+    candidates = [("keras", "none"), ("xla", "none"), ("tflite", "none"), ("tflite", "float16"), ("tflite", "int8")]
+    reference = None
+    agreed = True
+    for name, quantization in candidates:
+        label = name if name != "tflite" else f"tflite/{quantization}"
+        # Read-only: a check must not write conversions into the model directory
+        candidate = load_backend(name, model, quantization, version=model_state["version"], save=False)
+        candidate.predict(batch)  # warm-up: exclude tracing/allocation from the timing
+        started = time.perf_counter()
+        preds = candidate.predict(batch)
+        elapsed = (time.perf_counter() - started) * 1000
+        predicted = np.argmax(preds, axis=1)
+        if reference is None:
+            reference = (preds, predicted)
+        mismatches = [os.path.basename(p) for p, a, b in zip(paths, predicted, reference[1]) if a != b]
+        max_diff = float(np.max(np.abs(preds - reference[0])))
+        agreed = agreed and not mismatches
+        status = "✅" if not mismatches else f"❌ {len(mismatches)} mismatches: {', '.join(mismatches[:5])}"
+        print(f"{label:16} {elapsed:9.1f} ms  max |Δp| {max_diff:.5f}  {status}")
+    return agreed
+
+# --- Shared Inference Server ---
+# Multi-worker mode. Every uvicorn worker that imports TensorFlow and loads its
+# own copy of the CNN costs ~650 MB RSS for the TF runtime and warm-up graphs,
+# plus the model weights. Instead, run the model once in a dedicated process:
+#
+#   python app.py --inference-server /tmp/deepgyn-infer.sock
+#   DEEPGYN_INFERENCE_SERVER=/tmp/deepgyn-infer.sock uvicorn app:app --workers 8
+#
+# HTTP workers then never import TensorFlow (~170 MB RSS each: FastAPI, NumPy,
+# PIL, ReportLab) and send preprocessed float32 batches to the server through
+# shared memory. Only the request metadata and the N x 5 probabilities go over
+# the socket. Each worker keeps up to DEEPGYN_INFERENCE_WORKERS channels, and
+# each channel holds one segment sized for the largest batch bucket
+# (32 x 224 x 224 x 3 x 4 bytes = ~19 MB by default).
+#
+# Model replicas scale separately from HTTP workers: start several servers and
+# list them comma-separated, "host:port" or socket paths. Workers spread
+# their channels round-robin across them.
+#
+# The connection unpickles what peers send, so the authkey is the only thing
+# standing between the socket and code execution. Set DEEPGYN_INFERENCE_AUTHKEY
+# to a shared secret; without it, a random key is generated once into
+# DEEPGYN_INFERENCE_AUTHKEY_FILE (mode 0600), which the server and workers on
+# the same host share. A server listening beyond loopback requires the env var.
+INFERENCE_SERVERS = [a for a in os.environ.get("DEEPGYN_INFERENCE_SERVER", "").split(",") if a]
+INFERENCE_AUTHKEY_FILE = os.environ.get("DEEPGYN_INFERENCE_AUTHKEY_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".inference_authkey"))
+
+@functools.lru_cache(maxsize=1)
+def inference_authkey():
+    key = os.environ.get("DEEPGYN_INFERENCE_AUTHKEY")
+    if key:
+        return key.encode()
+    path = INFERENCE_AUTHKEY_FILE
+    if not os.path.exists(path):
+        # Write to a private temp file and link it into place, so concurrent
+        # workers agree on one key and nobody reads a half-written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    st = os.lstat(path)
+    if os.path.islink(path) or not os.path.isfile(path):
+        raise RuntimeError(f"{path} is not a regular file")
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o077):
+        raise RuntimeError(f"{path} must be owned by this user with mode 0600")
+    with open(path) as f:
+        return f.read().strip().encode()
+
+def parse_address(address):
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+def attach_segment(name):
+    # The client owns the segment; stop this process's resource tracker from
+    # unlinking it on exit (Python < 3.13 has no track=False)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+def serve_inference(address, threads):
+    bind = parse_address(address)
+    if isinstance(bind, tuple) and bind[0] not in ("127.0.0.1", "localhost", "::1") and not os.environ.get("DEEPGYN_INFERENCE_AUTHKEY"):
+        sys.exit("Listening beyond loopback requires DEEPGYN_INFERENCE_AUTHKEY to be set to a shared secret.")
+    authkey = inference_authkey()
+    load_model()
+    if backend is None: sys.exit("Model not loaded.")
+    if isinstance(bind, str) and os.path.exists(address):
+        os.unlink(address)
+    listener = Listener(bind, authkey=authkey)
+    slots = threading.BoundedSemaphore(max(1, threads))
+    print(f"✅ Inference server listening on {address}")
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=handle_inference_client, args=(conn, slots), daemon=True).start()
+
+def handle_inference_client(conn, slots):
+    segments = {}
+    try:
+        # Workers key their prediction caches on the model this server loaded
+        conn.send(("model", model_state["version"]))
+        while True:
+            name, n = conn.recv()
+            try:
+                if name not in segments:
+                    segments[name] = attach_segment(name)
+                batch = np.ndarray((n, *INPUT_SHAPE), dtype=np.float32, buffer=segments[name].buf)
+                with slots:
+                    preds = np.asarray(backend.predict(batch), dtype=np.float32)
+                del batch
+                conn.send(("ok", preds))
+            except Exception as e:
+                conn.send(("error", str(e)))
+    except (EOFError, OSError):
+        pass
+    finally:
+        for segment in segments.values():
+            segment.close()
+        conn.close()
+
+class RemoteChannel:
+    def __init__(self, address, capacity):
+        self.conn = Client(parse_address(address), authkey=inference_authkey())
+        _, self.model_version = self.conn.recv()
+        self.segment = shared_memory.SharedMemory(create=True, size=capacity * int(np.prod(INPUT_SHAPE)) * 4)
+        self.view = np.ndarray((capacity, *INPUT_SHAPE), dtype=np.float32, buffer=self.segment.buf)
+
+    def predict(self, batch):
+        self.view[:len(batch)] = batch
+        self.conn.send((self.segment.name, len(batch)))
+        status, payload = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def close(self):
+        del self.view
+        self.conn.close()
+        self.segment.close()
+        self.segment.unlink()
+
+class RemoteBackend:
+    name = "remote"
+
+    def __init__(self, addresses, capacity):
+        self.addresses = itertools.cycle(addresses)
+        self.capacity = capacity
+        self.idle = queue.SimpleQueue()
+        self.channels = []
+        self.lock = threading.Lock()
+        self.versions = {}
+
+    def channel(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                address = next(self.addresses)
+                channel = RemoteChannel(address, self.capacity)
+                self.channels.append(channel)
+                # A restarted server may have loaded a new model: whatever the
+                # newest channel to each server reports is what the cache keys on
+                self.versions[address] = channel.model_version
+                model_state["version"] = ",".join(sorted(map(str, set(self.versions.values()))))
+            return channel
+
+    def predict(self, batch):
+        channel = self.channel()
+        try:
+            preds = [channel.predict(batch[start:start + self.capacity])
+                     for start in range(0, len(batch), self.capacity)]
+        except Exception:
+            # A half-finished exchange leaves the connection unusable
+            with self.lock:
+                self.channels.remove(channel)
+            channel.close()
+            raise
+        self.idle.put(channel)
+        return np.concatenate(preds)
+
+    def close(self):
+        with self.lock:
+            for channel in self.channels:
+                channel.close()
+            self.channels.clear()
+
+def connect_inference_servers():
+    global backend
+    started = time.perf_counter()
+    remote = RemoteBackend(INFERENCE_SERVERS, batch_bucket(max(BATCH_MAX_SIZE, PREDICT_BATCH_SIZE)))
+    while True:
+        try:
+            remote.predict(np.zeros((1, *INPUT_SHAPE), dtype=np.float32))
+            break
+        except (OSError, EOFError) as e:
+            model_state["error"] = f"Waiting for inference server: {e}"
+            time.sleep(1)
+    model_state["phases"]["connect_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    backend = remote
+    model_state.update(status="ready", error=None)
+    print(f"✅ Using inference server(s): {', '.join(INFERENCE_SERVERS)}")
+
+# --- Inference Executor ---
+# PIL decoding and model.predict are blocking, so they run on a bounded pool
+# instead of the event loop. Requests beyond INFERENCE_QUEUE_DEPTH in flight
+# are turned away with a fast 503 rather than piling up latency.
+INFERENCE_WORKERS = int(os.environ.get("DEEPGYN_INFERENCE_WORKERS", "4"))
+INFERENCE_QUEUE_DEPTH = int(os.environ.get("DEEPGYN_INFERENCE_QUEUE_DEPTH", "64"))
+
+class ServerBusy(Exception):
+    pass
+
+def run_tracked(pid_name, fn, *args):
+    # Runs in a pool worker: publish the worker's pid before starting, so the
+    # parent can terminate it if the job times out. Spawned workers share the
+    # parent's resource tracker, which already tracks the segment.
+    segment = shared_memory.SharedMemory(name=pid_name)
+    struct.pack_into("q", segment.buf, 0, os.getpid())
+    segment.close()
+    return fn(*args)
+
+class BoundedExecutor:
+    def __init__(self, pool, max_pending, factory=None):
+        self.pool = pool
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        # Process pools only: factory builds a replacement pool, and killed
+        # holds pools broken on purpose to stop a timed-out job
+        self.factory = factory
+        self.killed = weakref.WeakSet()
+
+    @contextmanager
+    def slot(self):
+        # Only touched from the event loop, so a plain counter is enough
+        if self.pending >= self.max_pending:
+            raise ServerBusy()
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    def replace(self, pool):
+        if self.pool is pool:
+            self.pool = self.factory()
+            pool.shutdown(wait=False)
+
+    async def run(self, fn, *args, timeout=None):
+        if self.factory is not None:
+            return await self.run_in_process(fn, *args, timeout=timeout)
+        loop = asyncio.get_running_loop()
+        # Carry contextvars into the thread (a process pool can't take them)
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return await asyncio.wait_for(loop.run_in_executor(self.pool, call), timeout)
+
+    async def run_in_process(self, fn, *args, timeout=None):
+        # A running job can't be cancelled, so on timeout its worker is killed.
+        # That breaks the whole pool: it is replaced at once, and the other jobs
+        # it took down are run again on the new one.
+        for attempt in range(2):
+            pool = self.pool
+            pid = shared_memory.SharedMemory(create=True, size=8)
+            struct.pack_into("q", pid.buf, 0, 0)
+            try:
+                future = pool.submit(run_tracked, pid.name, fn, *args)
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except BrokenProcessPool:
+                # Otherwise a worker died on its own (OOM kill, segfault)
+                killed = pool in self.killed
+                self.replace(pool)
+                if not killed or attempt:
+                    raise
+            except asyncio.TimeoutError:
+                worker = struct.unpack_from("q", pid.buf, 0)[0]
+                if not future.done() and worker:
+                    self.killed.add(pool)
+                    self.replace(pool)
+                    os.kill(worker, getattr(signal, "SIGKILL", signal.SIGTERM))
+                raise
+            finally:
+                pid.close()
+                pid.unlink()
+
+inference = BoundedExecutor(ThreadPoolExecutor(max_workers=max(1, INFERENCE_WORKERS), thread_name_prefix="inference"),
+                            INFERENCE_QUEUE_DEPTH)
+
+@app.exception_handler(ServerBusy)
+async def server_busy_handler(request, exc):
+    return JSONResponse(status_code=503, content={"error": "Server busy, please retry."}, headers={"Retry-After": "1"})
+
+# --- Inference Engine (Dynamic Micro-Batching) ---
+# Concurrent /predict calls are queued and run through the CNN as one batch.
+# A batch is flushed when it reaches BATCH_MAX_SIZE images or when the oldest
+# request has waited BATCH_MAX_WAIT_MS, whichever happens first.
+BATCH_MAX_SIZE = int(os.environ.get("DEEPGYN_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("DEEPGYN_BATCH_MAX_WAIT_MS", "10"))
+
+async def collect_batch(queue, max_items, max_wait):
+    # Waits for one item, then keeps taking more until max_items or max_wait
+    items = [await queue.get()]
+    deadline = time.perf_counter() + max_wait
+    while len(items) < max_items:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+class BatchScheduler:
+    def __init__(self, executor, predict_fn, max_batch_size, max_wait_ms):
+        self.executor = executor
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.buffer = np.empty((self.max_batch_size, *INPUT_SHAPE), dtype=np.float32)
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        # Called from lifespan, so the queue and worker bind to the serving loop
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+        while self.queue is not None and not self.queue.empty():
+            _, future, _ = self.queue.get_nowait()
+            if not future.done(): future.set_exception(RuntimeError("Server is shutting down."))
+        self.queue = self.worker = None
+
+    async def submit(self, arr):
+        if self.queue is None:
+            raise RuntimeError("Batch scheduler is not running.")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((arr, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        # The task inherited the first caller's context; batches belong to no single request
+        request_stages.set(None)
+        while True:
+            items = await collect_batch(self.queue, self.max_batch_size, self.max_wait)
+            # Safe to reuse: the next batch isn't collected until this one returns
+            batch = np.stack([arr for arr, _, _ in items], out=self.buffer[:len(items)])
+            started = time.perf_counter()
+            try:
+                preds = await self.executor.run(self.predict_fn, batch)
+            except Exception as e:
+                for _, future, _ in items:
+                    if not future.done(): future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            for (_, future, enqueued), row in zip(items, preds):
+                if future.done(): continue  # client disconnected
+                future.set_result((row, {
+                    "batch_size": len(items),
+                    "queue_ms": round((started - enqueued) * 1000, 2),
+                    "inference_ms": round((finished - started) * 1000, 2),
+                    "latency_ms": round((finished - enqueued) * 1000, 2),
+                }))
+
+def run_model(batch):
+    batch_sizes.observe(len(batch))
+    with stage_timer("model_predict"):
+        return backend.predict(batch)
+
+scheduler = BatchScheduler(inference, run_model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+def format_prediction(preds):
+    result = dict(zip(classes, preds.tolist()))
+    predicted_class = classes[np.argmax(preds)]
+    predicted_category = category_map[predicted_class]
+
+    mapped_details = {
+        cls: {"category": category_map.get(cls, "Unknown"), "confidence": float(score)}
+        for cls, score in result.items()
+    }
+
+    return {
+        "prediction": predicted_category,
+        "confidence": float(np.max(preds)),
+        "details": result,
+        "mapped_details": mapped_details
+    }
+
+# --- Bulk Classification ---
+# Multi-image uploads skip the scheduler: the upload already is a batch, so each
+# PREDICT_BATCH_SIZE chunk is decoded in parallel on the pool and fed to the CNN
+# in one call. Only one chunk of decoded images is alive at a time.
+PREDICT_BATCH_SIZE = int(os.environ.get("DEEPGYN_PREDICT_BATCH_SIZE", "32"))
+category_severity = ["High Risk / Cancerous", "Pre-cancerous", "Normal"]
+
+def iter_upload_entries(upload):
+    # Yields (filename, file object), unpacking zip/tar archives one member at a time
+    fp = upload.file
+    name = upload.filename or "upload"
+    if zipfile.is_zipfile(fp):
+        fp.seek(0)
+        with zipfile.ZipFile(fp) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image_entry(info.filename):
+                    yield info.filename, (io.BytesIO(archive.read(info)) if info.file_size <= MAX_UPLOAD_BYTES
+                                          else oversized_entry(info.file_size))
+        return
+    fp.seek(0)
+    try:
+        archive = tarfile.open(fileobj=fp, mode="r:*")
+    except tarfile.ReadError:
+        fp.seek(0)
+        yield name, fp
+        return
+    with archive:
+        for member in archive:
+            if member.isfile() and is_image_entry(member.name):
+                yield member.name, (io.BytesIO(archive.extractfile(member).read()) if member.size <= MAX_UPLOAD_BYTES
+                                    else oversized_entry(member.size))
+
+def oversized_entry(size):
+    # Stands in for the file object; classify_chunk reports it without extracting
+    return UploadRejected(413, f"Entry is {size} bytes; the limit is {MAX_UPLOAD_BYTES}.")
+
+def iter_entries(files):
+    for upload in files:
+        yield from iter_upload_entries(upload)
+
+def take(iterator, n):
+    return [entry for _, entry in zip(range(n), iterator)]
+
+def is_image_entry(path):
+    # Skip OS metadata (__MACOSX/, ._foo.png, .DS_Store) that ends up in archives
+    base = os.path.basename(path)
+    return not path.startswith("__MACOSX/") and not base.startswith(".")
+
+async def classify_chunk(entries, timing):
+    started = time.perf_counter()
+    batch = np.empty((len(entries), *INPUT_SHAPE), dtype=np.float32)
+    decoded = await asyncio.gather(*[inference.run(preprocess_image, fp, batch[i]) if not isinstance(fp, Exception)
+                                     else asyncio.sleep(0, fp) for i, (_, fp) in enumerate(entries)],
+                                   return_exceptions=True)
+    decoded_at = time.perf_counter()
+
+    results = [None] * len(entries)
+    ok = []
+    for i, ((filename, _), arr) in enumerate(zip(entries, decoded)):
+        if isinstance(arr, Exception):
+            results[i] = {"filename": filename, "error": str(arr)}
+        else:
+            ok.append(i)
+    if ok:
+        preds = await inference.run(run_model, batch if len(ok) == len(entries) else batch[ok])
+        for i, row in zip(ok, preds):
+            results[i] = {"filename": entries[i][0], **format_prediction(row)}
+
+    timing["images"] += len(entries)
+    timing["decode_ms"] += (decoded_at - started) * 1000
+    timing["inference_ms"] += (time.perf_counter() - decoded_at) * 1000
+    return results
+
+def new_timing():
+    return {"images": 0, "decode_ms": 0.0, "inference_ms": 0.0}
+
+def summarize_predictions(results):
+    scored = [r for r in results if "error" not in r]
+    category_counts = {category: 0 for category in category_severity}
+    class_counts = {cls: 0 for cls in classes}
+    for r in scored:
+        category_counts[r["prediction"]] += 1
+        class_counts[max(r["details"], key=r["details"].get)] += 1
+    mean_details = {
+        cls: (sum(r["details"][cls] for r in scored) / len(scored) if scored else 0.0)
+        for cls in classes
+    }
+    highest_risk = next((c for c in category_severity if category_counts[c]), None)
+    return {
+        "total": len(results),
+        "classified": len(scored),
+        "failed": len(results) - len(scored),
+        "highest_risk": highest_risk,
+        "category_counts": category_counts,
+        "class_counts": class_counts,
+        "mean_details": mean_details,
+    }
+
+# --- Test-Time Augmentation ---
+# /predict?tta=true classifies several views of the micrograph instead of one:
+# the eight rotations/flips of the resized image (cells have no orientation)
+# plus a center and four corner crops from a TTA_CROP_SCALE-times larger
+# resize. All views are filled into one float32 batch from a single decode and
+# go through the model in one call, so the cost is one batched forward pass.
+# The response is the mean softmax over views, with the per-class variance
+# and the share of views agreeing with the final class as uncertainty signals.
+TTA_CROP_SCALE = float(os.environ.get("DEEPGYN_TTA_CROP_SCALE", "1.15"))
+TTA_VIEWS = 13
+
+def preprocess_tta(fp):
+    side = max(INPUT_SIZE[0], round(INPUT_SIZE[0] * TTA_CROP_SCALE))
+    img = decode_image(fp, (side, side))
+    started = time.perf_counter()
+    views = np.empty((TTA_VIEWS, *INPUT_SHAPE), dtype=np.float32)
+    base = resize_into(img, INPUT_SIZE, views[0])
+    for k in range(1, 4):
+        views[k] = np.rot90(base, k)
+    views[4:8] = views[0:4, :, ::-1]
+    large = resize_into(img, (side, side), np.empty((side, side, 3), dtype=np.float32))
+    h, w = INPUT_SIZE
+    offsets = [((side - h) // 2, (side - w) // 2), (0, 0), (0, side - w), (side - h, 0), (side - h, side - w)]
+    for i, (y, x) in enumerate(offsets, start=8):
+        views[i] = large[y:y + h, x:x + w]
+    observe_stage("image_resize", time.perf_counter() - started)
+    return views
+
+def format_tta_prediction(view_preds):
+    mean = view_preds.mean(axis=0)
+    variance = view_preds.var(axis=0)
+    response = format_prediction(mean)
+    top = int(np.argmax(mean))
+    response["tta"] = {
+        "views": len(view_preds),
+        "variance": dict(zip(classes, variance.tolist())),
+        "predicted_class_std": float(np.sqrt(variance[top])),
+        "agreement": float(np.mean(view_preds.argmax(axis=1) == top)),
+    }
+    return response
+
+# --- Prediction Cache ---
+# /predict results keyed by a SHA-256 of the uploaded bytes. Entries live in an
+# in-memory LRU (size + TTL bounded) and, if PREDICTION_CACHE_DB is set, in a
+# SQLite table that survives restarts. Both tiers are tied to the mtime/size of
+# the model file load_model() actually loaded (or the one the inference server
+# reports), so a reload after replacing cnn_model.h5 invalidates everything.
+# The SQLite tier is pruned every PREDICTION_CACHE_PRUNE_EVERY writes: expired
+# rows are deleted and only the newest PREDICTION_CACHE_DB_ROWS are kept.
+PREDICTION_CACHE_SIZE = int(os.environ.get("DEEPGYN_PREDICTION_CACHE_SIZE", "1024"))
+PREDICTION_CACHE_TTL = float(os.environ.get("DEEPGYN_PREDICTION_CACHE_TTL", "3600"))
+PREDICTION_CACHE_DB = os.environ.get("DEEPGYN_PREDICTION_CACHE_DB", "")
+PREDICTION_CACHE_DB_ROWS = int(os.environ.get("DEEPGYN_PREDICTION_CACHE_DB_ROWS", "100000"))
+PREDICTION_CACHE_PRUNE_EVERY = 256
+
+class PredictionCache:
+    def __init__(self, max_entries, ttl, db_path):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.model_version = None
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "persistent_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self.db_writes = itertools.count(1)
+        if db_path:
+            conn = sqlite3.connect(db_path)
+            conn.execute("CREATE TABLE IF NOT EXISTS prediction_cache (key TEXT PRIMARY KEY, model_version TEXT, preds TEXT, created REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_prediction_cache_created ON prediction_cache (created)")
+            self._db_prune(conn, time.time())
+            conn.commit()
+            conn.close()
+
+    def check_model(self):
+        version = model_state["version"]
+        if version == self.model_version:
+            return False
+        if self.model_version is not None:
+            self.stats["invalidations"] += 1
+        self.entries.clear()
+        self.model_version = version
+        return True
+
+    async def get(self, key):
+        if self.max_entries <= 0 or model_state["version"] is None:
+            return None
+        if self.check_model() and self.db_path:
+            await asyncio.to_thread(self._db_purge, self.model_version)
+        entry = self.entries.get(key)
+        if entry is not None:
+            preds, created = entry
+            if time.time() - created <= self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return preds
+            del self.entries[key]
+        if self.db_path:
+            row = await asyncio.to_thread(self._db_get, key, self.model_version)
+            if row is not None and time.time() - row[1] <= self.ttl:
+                self._remember(key, row[0], row[1])
+                self.stats["persistent_hits"] += 1
+                return row[0]
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key, preds):
+        if self.max_entries <= 0 or self.model_version is None:
+            return
+        created = time.time()
+        self._remember(key, preds, created)
+        if self.db_path:
+            await asyncio.to_thread(self._db_put, key, self.model_version, preds, created)
+
+    def _remember(self, key, preds, created):
+        self.entries[key] = (preds, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _db_get(self, key, version):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT preds, created FROM prediction_cache WHERE key = ? AND model_version = ?", (key, version)).fetchone()
+        conn.close()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def _db_put(self, key, version, preds, created):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT OR REPLACE INTO prediction_cache (key, model_version, preds, created) VALUES (?, ?, ?, ?)",
+                     (key, version, json.dumps(preds), created))
+        if next(self.db_writes) % PREDICTION_CACHE_PRUNE_EVERY == 0:
+            self._db_prune(conn, created)
+        conn.commit()
+        conn.close()
+
+    def _db_prune(self, conn, now):
+        conn.execute("DELETE FROM prediction_cache WHERE created < ?", (now - self.ttl,))
+        # The row cap's cutoff is read off idx_prediction_cache_created
+        conn.execute("""
+            DELETE FROM prediction_cache WHERE created < (
+                SELECT created FROM prediction_cache ORDER BY created DESC LIMIT 1 OFFSET ?)
+        """, (PREDICTION_CACHE_DB_ROWS - 1,))
+
+    def _db_purge(self, version):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("DELETE FROM prediction_cache WHERE model_version != ?", (version,))
+        conn.commit()
+        conn.close()
+
+    def snapshot(self):
+        return {**self.stats, "entries": len(self.entries), "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl, "persistent": bool(self.db_path)}
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL, PREDICTION_CACHE_DB)
+
+
+# --- Write-Behind Ingestion ---
+# With DEEPGYN_WRITE_BEHIND=1, /save-scan rows are queued and written in one
+# transaction every WRITE_BATCH_ROWS rows or WRITE_BATCH_MS, instead of one
+# commit per request. DEEPGYN_WRITE_ACK picks the durability trade-off:
+#   commit  - the request waits until its batch is committed (returns the id)
+#   enqueue - the request returns as soon as the row is queued; rows still in
+#             the queue are lost if the process is killed
+# The queue is flushed on shutdown either way.
+WRITE_BEHIND = os.environ.get("DEEPGYN_WRITE_BEHIND", "0") == "1"
+WRITE_BATCH_ROWS = int(os.environ.get("DEEPGYN_WRITE_BATCH_ROWS", "200"))
+WRITE_BATCH_MS = float(os.environ.get("DEEPGYN_WRITE_BATCH_MS", "10"))
+WRITE_QUEUE_LIMIT = int(os.environ.get("DEEPGYN_WRITE_QUEUE_LIMIT", "10000"))
+WRITE_ACK = os.environ.get("DEEPGYN_WRITE_ACK", "commit").lower()
+
+class WriteBehindQueue:
+    def __init__(self, pool, max_rows, max_wait_ms, max_queued, ack):
+        if ack not in ("commit", "enqueue"):
+            raise ValueError(f"Unknown write ack mode '{ack}'")
+        self.pool = pool
+        self.max_rows = max(1, max_rows)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_queued = max_queued
+        self.ack = ack
+        self.queue = None
+        self.worker = None
+        self.stats = {"enqueued": 0, "written": 0, "failed": 0, "flushes": 0,
+                      "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+
+    def start(self):
+        # Called from lifespan, so the queue and worker bind to the serving loop
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self.worker = asyncio.create_task(self._run())
+
+    async def submit(self, row):
+        if self.queue is None:
+            raise RuntimeError("Write-behind queue is not running.")
+        future = asyncio.get_running_loop().create_future() if self.ack == "commit" else None
+        await self.queue.put((row, future))  # blocks when full: backpressure instead of unbounded RAM
+        self.stats["enqueued"] += 1
+        return await future if future is not None else None
+
+    async def _run(self):
+        request_stages.set(None)
+        while True:
+            items = await collect_batch(self.queue, self.max_rows, self.max_wait)
+            stop = any(item is None for item in items)
+            await self._flush([item for item in items if item is not None])
+            if stop:
+                return
+
+    async def _flush(self, items):
+        if not items:
+            return
+        started = time.perf_counter()
+        try:
+            ids = await self.pool.run(insert_scans, [row for row, _ in items])
+        except Exception as e:
+            self.stats["failed"] += len(items)
+            print(f"❌ Write-behind flush of {len(items)} scans failed: {e}")
+            for _, future in items:
+                if future is not None and not future.done(): future.set_exception(e)
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        self.stats["flushes"] += 1
+        self.stats["written"] += len(items)
+        self.stats["last_flush_ms"] = round(elapsed, 2)
+        self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed), 2)
+        self.stats["total_flush_ms"] += elapsed
+        for (_, future), scan_id in zip(items, ids):
+            if future is not None and not future.done(): future.set_result(scan_id)
+
+    async def close(self):
+        # The sentinel goes behind everything already queued, so all of it is flushed
+        if self.worker is not None and not self.worker.done():
+            await self.queue.put(None)
+            await self.worker
+        self.queue = self.worker = None
+
+    def snapshot(self):
+        flushes = self.stats["flushes"]
+        return {**self.stats,
+                "total_flush_ms": round(self.stats["total_flush_ms"], 2),
+                "avg_flush_ms": round(self.stats["total_flush_ms"] / flushes, 2) if flushes else 0.0,
+                "avg_rows_per_flush": round(self.stats["written"] / flushes, 2) if flushes else 0.0,
+                "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "enabled": WRITE_BEHIND, "ack": self.ack,
+                "batch_rows": self.max_rows, "batch_ms": self.max_wait * 1000}
+
+writer = WriteBehindQueue(db, WRITE_BATCH_ROWS, WRITE_BATCH_MS, WRITE_QUEUE_LIMIT, WRITE_ACK)
+
 # --- Pydantic Models ---
 class ScanData(BaseModel):
     doctor_email: str
@@ -712,113 +2593,297 @@ class ScanData(BaseModel):
     prediction: str
     confidence: float
 
+class ExportRequest(BaseModel):
+    doctor_email: str
+    start: Optional[date] = None
+    end: Optional[date] = None
+    format: str = "pdf"
+
 # --- Routes ---
 
 @app.get("/", response_class=HTMLResponse)
-async def home():
-    return html_content
+async def home(accept_encoding: Optional[str] = Header(None), if_none_match: Optional[str] = Header(None)):
+    encoding = negotiate_encoding(accept_encoding, frontend_variants)
+    body, etag = frontend_variants[encoding]
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    lines = []
+    for metric in all_metrics:
+        lines.extend(metric.expose())
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    ready = model_state["status"] == "ready"
+    return JSONResponse(status_code=200 if ready else 503, content={
+        **model_state,
+        "backend": backend.name if backend is not None else None,
+    })
+
+async def classify_upload(file):
+    with stage_timer("upload_read"):
+        key = await inference.run(hash_upload, file.file)
+    cached = await prediction_cache.get(key)
+    if cached is not None:
+        response = format_prediction(np.array(cached))
+        response["timing"] = {"cache": "hit"}
+        return response
+
+    decode_started = time.perf_counter()
+    arr = await inference.run(preprocess_image, file.file)
+    preprocess_ms = round((time.perf_counter() - decode_started) * 1000, 2)
+    preds, timing = await scheduler.submit(arr)
+    note_stage("batch_queue", timing["queue_ms"] / 1000)
+    note_stage("model_predict", timing["inference_ms"] / 1000)
+    await prediction_cache.put(key, preds.tolist())
+    response = format_prediction(preds)
+    response["timing"] = {"cache": "miss", "preprocess_ms": preprocess_ms, **timing}
+    return response
+
+async def classify_upload_tta(file):
+    with stage_timer("upload_read"):
+        key = "tta:" + await inference.run(hash_upload, file.file)
+    cached = await prediction_cache.get(key)
+    if cached is not None:
+        response = format_tta_prediction(np.array(cached))
+        response["timing"] = {"cache": "hit"}
+        return response
+
+    started = time.perf_counter()
+    views = await inference.run(preprocess_tta, file.file)
+    decoded = time.perf_counter()
+    # A whole batch already, so it skips the micro-batching scheduler like /predict-batch
+    view_preds = await inference.run(run_model, views)
+    finished = time.perf_counter()
+    await prediction_cache.put(key, view_preds.tolist())
+    response = format_tta_prediction(view_preds)
+    response["timing"] = {"cache": "miss", "preprocess_ms": round((decoded - started) * 1000, 2),
+                          "inference_ms": round((finished - decoded) * 1000, 2),
+                          "latency_ms": round((finished - started) * 1000, 2)}
+    return response
 
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
-    if model is None: return {"error": "Model not loaded."}
+async def predict(file: UploadFile = File(...), tta: bool = Query(False)):
+    if backend is None: return model_unavailable()
+    with inference.slot():
+        try:
+            return await (classify_upload_tta(file) if tta else classify_upload(file))
+        except UploadRejected:
+            raise
+        except Exception as e:
+            return {"error": str(e)}
+
+# Inference and /save-scan in one request. The saved prediction comes from the
+# server, not the client; with DEEPGYN_WRITE_BEHIND=1 and DEEPGYN_WRITE_ACK=enqueue
+# the insert happens after the response ("scan_id": null, "status": "queued").
+@app.post("/predict-and-save")
+async def predict_and_save(
+    file: UploadFile = File(...),
+    name: str = Form(...),
+    age: int = Form(...),
+    location: str = Form(...),
+    doctor_email: str = Form(...)
+):
+    if backend is None: return model_unavailable()
+    with inference.slot():
+        try:
+            response = await classify_upload(file)
+        except UploadRejected:
+            raise
+        except Exception as e:
+            return {"error": str(e)}
+
+    row = scan_row(doctor_email, name, age, location, response["prediction"], response["confidence"], time.time(),
+                   response["details"])
     try:
-        img = Image.open(file.file).resize((224, 224))
-        arr = np.expand_dims(np.array(img) / 255.0, axis=0)
-        preds = model.predict(arr)[0]
-
-        result = dict(zip(classes, preds.tolist()))
-        predicted_class = classes[np.argmax(preds)]
-        predicted_category = category_map[predicted_class]
-
-        mapped_details = {
-            cls: {"category": category_map.get(cls, "Unknown"), "confidence": float(score)}
-            for cls, score in result.items()
-        }
-
-        return {
-            "prediction": predicted_category,
-            "confidence": float(np.max(preds)),
-            "details": result,
-            "mapped_details": mapped_details
-        }
+        if WRITE_BEHIND:
+            scan_id = await writer.submit(row)
+        else:
+            scan_id = (await db.run(insert_scans, [row]))[0]
     except Exception as e:
-        return {"error": str(e)}
+        return {**response, "error": f"Failed to save scan: {e}"}
+    return {**response, "scan_id": scan_id, "status": "saved" if scan_id is not None else "queued"}
+
+@app.post("/predict-batch")
+async def predict_batch(files: List[UploadFile] = File(...)):
+    if backend is None: return model_unavailable()
+    with inference.slot():
+        try:
+            started = time.perf_counter()
+            timing = new_timing()
+            entries = iter_entries(files)
+            results = []
+            while chunk := await inference.run(take, entries, PREDICT_BATCH_SIZE):
+                results.extend(await classify_chunk(chunk, timing))
+            timing = {k: round(v, 2) for k, v in timing.items()}
+            timing["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            return {"results": results, "summary": summarize_predictions(results), "timing": timing}
+        except Exception as e:
+            return {"error": str(e)}
+
+class HeldStreamingResponse(StreamingResponse):
+    # Releases `held` once the response is over, also when the body iterator
+    # never started (the client left before the headers went out)
+    def __init__(self, content, held, **kwargs):
+        super().__init__(content, **kwargs)
+        self.held = held
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.held.close()
+
+# Same work as /predict-batch, but emits one NDJSON line per image as soon as
+# its chunk is classified instead of buffering the whole result set. The slot
+# is taken before the response starts, so a full server answers 503, not a 200
+# with an error line.
+@app.post("/predict-stream")
+async def predict_stream(files: List[UploadFile] = File(...)):
+    if backend is None: return model_unavailable()
+    held = ExitStack()
+    held.enter_context(inference.slot())
+
+    async def lines():
+        try:
+            entries = iter_entries(files)
+            timing = new_timing()
+            while chunk := await inference.run(take, entries, PREDICT_BATCH_SIZE):
+                for result in await classify_chunk(chunk, timing):
+                    yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            held.close()
+
+    return HeldStreamingResponse(lines(), held, media_type="application/x-ndjson")
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return prediction_cache.snapshot()
 
 @app.post("/save-scan")
 async def save_scan(data: ScanData):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT INTO scans (doctor_email, name, age, location, prediction, confidence, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
-              (data.doctor_email, data.name, data.age, data.location, data.prediction, data.confidence, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-    return {"status": "saved"}
-
+    row = scan_row(data.doctor_email, data.name, data.age, data.location, data.prediction, data.confidence, time.time())
+    if WRITE_BEHIND:
+        scan_id = await writer.submit(row)
+        if scan_id is None:
+            return {"status": "queued"}
+    else:
+        scan_id = (await db.run(insert_scans, [row]))[0]
+    return {"status": "saved", "id": scan_id}
+
+@app.get("/write-stats")
+async def write_stats():
+    return writer.snapshot()
+
+HISTORY_PAGE_SIZE = int(os.environ.get("DEEPGYN_HISTORY_PAGE_SIZE", "100"))
+HISTORY_MAX_PAGE_SIZE = 1000
+
+# Keyset pagination: pass the returned next_before_id back as before_id to get
+# the next (older) page. start/end are inclusive calendar dates.
 @app.get("/history")
-async def get_history(email: str):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM scans WHERE doctor_email = ? ORDER BY id DESC", (email,))
-    rows = c.fetchall()
-    conn.close()
-    return {"history": [dict(row) for row in rows]}
+async def get_history(
+    email: str,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    before_id: Optional[int] = None,
+    fields: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+):
+    columns = HISTORY_COLUMNS
+    if fields:
+        requested = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in requested if f not in HISTORY_COLUMNS]
+        if unknown:
+            return JSONResponse(status_code=400, content={"error": f"Unknown fields: {', '.join(unknown)}"})
+        # id is always returned, it is the pagination cursor
+        columns = tuple(c for c in HISTORY_COLUMNS if c == "id" or c in requested)
+
+    rows = await db.run(fetch_history, email, limit, before_id, columns, start, end)
+    next_before_id = rows[-1]["id"] if len(rows) == limit else None
+    return {"history": rows, "next_before_id": next_before_id}
+
+# Scan counts from the scan_stats summary, grouped by any of doctor_email,
+# location, prediction and day. confidence_histogram[i] counts scans whose
+# confidence falls in [i * 10%, (i + 1) * 10%).
+@app.get("/analytics")
+async def get_analytics(
+    group_by: str = "doctor_email,location,prediction,day",
+    doctor_email: Optional[str] = None,
+    location: Optional[str] = None,
+    prediction: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+):
+    dimensions = [d.strip() for d in group_by.split(",") if d.strip()]
+    unknown = [d for d in dimensions if d not in ANALYTICS_DIMENSIONS]
+    if unknown:
+        return JSONResponse(status_code=400, content={"error": f"Unknown group_by: {', '.join(unknown)}"})
+    dimensions = [d for d in ANALYTICS_DIMENSIONS if d in dimensions]
+    filters = {k: v for k, v in (("doctor_email", doctor_email), ("location", location), ("prediction", prediction)) if v is not None}
+
+    rows = await db.run(fetch_analytics, dimensions, filters, start, end)
+    return {"group_by": dimensions, "rows": rows}
 
 # --- REPORT GENERATION (PROFESSIONAL REPORTLAB PDF) ---
-@app.post("/generate-report")
-async def generate_report(
-    prediction: str = Body(...),
-    confidence: float = Body(...),
-    details: dict = Body(...),
-    patientName: str = Body(...),
-    patientAge: int = Body(...),
-    patientLocation: str = Body(...)
-):
-    try:
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        
-        # --- PDF SETUP ---
-        doc = SimpleDocTemplate(temp_file.name, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-        elements = []
+# Everything that doesn't depend on the patient (styles, logo, lab header,
+# table styles, signature block, disclaimer) is built once. Per request only
+# the demographics, result and probability flowables are created, and the PDF
+# is rendered into memory. The shared flowables are only wrapped, never split,
+# so reusing them across sequential builds is safe; a template instance must
+# not be rendered from two threads at once.
+# Bump whenever the layout below changes so cached PDFs are not reused
+REPORT_TEMPLATE_VERSION = "2"
+
+def derive_patient_id(patient_name, patient_age, patient_location):
+    # Stable per patient, so repeated downloads are identical (and cacheable)
+    digest = hashlib.sha256(f"{patient_name}|{patient_age}|{patient_location}".encode()).digest()
+    return f"DG-{1000 + int.from_bytes(digest[:4], 'big') % 9000}"
+
+class ReportTemplate:
+    def __init__(self):
         styles = getSampleStyleSheet()
-        
-        # Custom Styles
-        title_style = ParagraphStyle(name='Title', parent=styles['Heading1'], alignment=1, fontSize=18, spaceAfter=20)
-        normal_style = styles['Normal']
+        self.normal_style = styles['Normal']
+        self.heading3_style = styles['Heading3']
+        self.heading4_style = styles['Heading4']
+        self.title_style = ParagraphStyle(name='Title', parent=styles['Heading1'], alignment=1, fontSize=18, spaceAfter=20)
         header_text_style = ParagraphStyle(name='Header', parent=styles['Normal'], alignment=2, fontSize=9)
-        
+        footer_style = ParagraphStyle(name='Footer', parent=styles['Normal'], fontSize=7, textColor=colors.grey, alignment=4) # Justify
+
         # --- 1. HEADER (Logo Placeholder + Lab Info) ---
         # Drawing a simple "Logo" using graphics since we can't rely on external images in a single file
         d = Drawing(100, 50)
         d.add(Rect(0, 0, 100, 50, fillColor=colors.HexColor('#00d2ff'), strokeColor=None))
         d.add(String(10, 20, "DEEPGYN", fontSize=14, fillColor=colors.white))
         d.add(String(10, 10, "SCAN AI", fontSize=8, fillColor=colors.white))
-        
+
         # Table for Header (Logo Left, Text Right)
         header_data = [
             [d, Paragraph("<b>DEEPGYNSCAN DIAGNOSTICS LAB</b><br/>KPRIET, Coimbatore<br/>Licence No: 2764<br/>Phone: +91 8072568527", header_text_style)]
         ]
-        header_table = Table(header_data, colWidths=[120, 400])
-        header_table.setStyle(TableStyle([
+        self.header_table = Table(header_data, colWidths=[120, 400])
+        self.header_table.setStyle(TableStyle([
             ('VALIGN', (0,0), (-1,-1), 'TOP'),
             ('ALIGN', (1,0), (1,0), 'RIGHT'),
         ]))
-        elements.append(header_table)
-        elements.append(Spacer(1, 20))
-        
+
         # --- 2. TITLE ---
-        elements.append(Paragraph("CERVICAL CYTOLOGY AI ANALYSIS", title_style))
-        elements.append(Spacer(1, 10))
-        
+        self.title = Paragraph("CERVICAL CYTOLOGY AI ANALYSIS", self.title_style)
+
         # --- 3. PATIENT DEMOGRAPHICS (Grid) ---
-        patient_data = [
-            ["Patient Name:", patientName, "Patient ID:", "DG-" + str(random.randint(1000,9999))],
-            ["Age / Gender:", f"{patientAge} Years / Female", "Date:", datetime.now().strftime("%Y-%m-%d")],
-            ["Referred By:", "DeepGynScan AI", "Location:", patientLocation]
-        ]
-        
-        t_patient = Table(patient_data, colWidths=[90, 180, 90, 170])
-        t_patient.setStyle(TableStyle([
+        self.patient_table_style = TableStyle([
             ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
             ('BACKGROUND', (0,0), (0,-1), colors.whitesmoke),
             ('BACKGROUND', (2,0), (2,-1), colors.whitesmoke),
@@ -827,46 +2892,14 @@ async def generate_report(
             ('PADDING', (0,0), (-1,-1), 8),
             ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
             ('FONTNAME', (2,0), (2,-1), 'Helvetica-Bold'),
-        ]))
-        elements.append(t_patient)
-        elements.append(Spacer(1, 25))
-        
+        ])
+
         # --- 4. DIAGNOSIS RESULT ---
-        # Determine Color based on result
-        res_color = "green"
-        if "High" in prediction: res_color = "red"
-        elif "Pre" in prediction: res_color = "orange"
-        
-        elements.append(Paragraph("<b>CLINICAL IMPRESSION:</b>", styles['Heading3']))
-        result_html = f"<font size='14' color='{res_color}'><b>{prediction}</b></font>"
-        elements.append(Paragraph(result_html, styles['Normal']))
-        elements.append(Spacer(1, 10))
-        elements.append(Paragraph(f"<b>AI Model Confidence:</b> {confidence*100:.2f}%", styles['Normal']))
-        elements.append(Spacer(1, 20))
-        
+        self.impression_heading = Paragraph("<b>CLINICAL IMPRESSION:</b>", self.heading3_style)
+
         # --- 5. CONFIDENCE BREAKDOWN TABLE ---
-        elements.append(Paragraph("<b>Detailed Class Probabilities:</b>", styles['Heading4']))
-        
-        # Header for the table
-        table_data = [["Class Name", "Risk Category", "Probability Score"]]
-        
-        # Sort details by score
-        sorted_details = sorted(details.items(), key=lambda x: x[1], reverse=True)
-        
-        for cls, score in sorted_details:
-            mapped_cls_category = category_map.get(cls, "Unknown")
-            # Drawing a small bar for visualization inside table
-            bar_width = int(score * 100)
-            bar_color = colors.green
-            if "High" in mapped_cls_category: bar_color = colors.red
-            elif "Pre" in mapped_cls_category: bar_color = colors.orange
-            
-            # Simple text representation of bar for robustness
-            prob_text = f"{score*100:.2f}%"
-            table_data.append([cls.replace("im_", ""), mapped_cls_category, prob_text])
-            
-        t_conf = Table(table_data, colWidths=[200, 200, 100])
-        t_conf.setStyle(TableStyle([
+        self.breakdown_heading = Paragraph("<b>Detailed Class Probabilities:</b>", self.heading4_style)
+        self.confidence_table_style = TableStyle([
             ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#00d2ff')),
             ('TEXTCOLOR', (0,0), (-1,0), colors.white),
             ('ALIGN', (0,0), (-1,-1), 'CENTER'),
@@ -876,33 +2909,487 @@ async def generate_report(
             ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey),
             ('ROWBACKGROUNDS', (0,1), (-1,-1), [colors.whitesmoke, colors.white]),
             ('PADDING', (0,0), (-1,-1), 8),
-        ]))
-        elements.append(t_conf)
-        elements.append(Spacer(1, 40))
-        
+        ])
+
         # --- 6. FOOTER / SIGNATURE ---
         sig_data = [
             ["_______________________", "_______________________"],
             ["AI System Generated", "Chief Pathologist Signature"]
         ]
-        t_sig = Table(sig_data, colWidths=[250, 250])
-        t_sig.setStyle(TableStyle([
+        self.signature_table = Table(sig_data, colWidths=[250, 250])
+        self.signature_table.setStyle(TableStyle([
             ('ALIGN', (0,0), (-1,-1), 'CENTER'),
             ('FONTSIZE', (0,0), (-1,-1), 8),
             ('TEXTCOLOR', (0,0), (-1,-1), colors.grey),
         ]))
-        elements.append(t_sig)
-        elements.append(Spacer(1, 10))
-        
+
         disclaimer = "<b>DISCLAIMER:</b> This report is generated by an Artificial Intelligence system (DeepGynScan) and serves as a preliminary screening tool. It does not replace a professional medical diagnosis. All results must be clinically correlated and verified by a certified pathologist."
-        elements.append(Paragraph(disclaimer, ParagraphStyle(name='Footer', parent=styles['Normal'], fontSize=7, textColor=colors.grey, alignment=4))) # Justify
-        
-        # BUILD PDF
-        doc.build(elements)
+        self.disclaimer = Paragraph(disclaimer, footer_style)
+
+    def patient_flowables(self, prediction, confidence, details, patient_name, patient_age, patient_location,
+                          patient_id, report_date):
+        elements = []
+        patient_data = [
+            ["Patient Name:", patient_name, "Patient ID:", patient_id],
+            ["Age / Gender:", f"{patient_age} Years / Female", "Date:", report_date],
+            ["Referred By:", "DeepGynScan AI", "Location:", patient_location]
+        ]
+        t_patient = Table(patient_data, colWidths=[90, 180, 90, 170])
+        t_patient.setStyle(self.patient_table_style)
+        elements.append(t_patient)
+        elements.append(Spacer(1, 25))
 
-        return FileResponse(temp_file.name, filename="DeepGynScan_Report.pdf", media_type="application/pdf")
+        # Determine Color based on result
+        res_color = "green"
+        if "High" in prediction: res_color = "red"
+        elif "Pre" in prediction: res_color = "orange"
+
+        elements.append(self.impression_heading)
+        # prediction is client input (/save-scan), and Paragraph parses markup
+        result_html = f"<font size='14' color='{res_color}'><b>{escape(prediction)}</b></font>"
+        elements.append(Paragraph(result_html, self.normal_style))
+        elements.append(Spacer(1, 10))
+        elements.append(Paragraph(f"<b>AI Model Confidence:</b> {confidence*100:.2f}%", self.normal_style))
+        elements.append(Spacer(1, 20))
+
+        if not details:
+            # Scans saved through /save-scan only record the top category
+            return elements
+
+        elements.append(self.breakdown_heading)
+        table_data = [["Class Name", "Risk Category", "Probability Score"]]
+        # Sort details by score
+        for cls, score in sorted(details.items(), key=lambda x: x[1], reverse=True):
+            table_data.append([cls.replace("im_", ""), category_map.get(cls, "Unknown"), f"{score*100:.2f}%"])
+        t_conf = Table(table_data, colWidths=[200, 200, 100])
+        t_conf.setStyle(self.confidence_table_style)
+        elements.append(t_conf)
+        elements.append(Spacer(1, 40))
+        return elements
+
+    def report_flowables(self, prediction, confidence, details, patient_name, patient_age, patient_location,
+                         patient_id=None, report_date=None):
+        elements = [self.header_table, Spacer(1, 20), self.title, Spacer(1, 10)]
+        elements.extend(self.patient_flowables(
+            prediction, confidence, details, patient_name, patient_age, patient_location,
+            patient_id or derive_patient_id(patient_name, patient_age, patient_location),
+            report_date or datetime.now().strftime("%Y-%m-%d"),
+        ))
+        elements.extend([self.signature_table, Spacer(1, 10), self.disclaimer])
+        return elements
+
+    def document(self, target):
+        # invariant drops the creation timestamp and random document ID, so the
+        # same inputs always produce byte-identical PDFs
+        return SimpleDocTemplate(target, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30,
+                                 invariant=True)
+
+    def render(self, *args, **kwargs):
+        buffer = io.BytesIO()
+        self.document(buffer).build(self.report_flowables(*args, **kwargs))
+        return buffer.getvalue()
+
+report_template = ReportTemplate()
+
+# doc.build() is CPU-bound pure Python, so PDFs are rendered in a process pool:
+# the event loop stays free and throughput scales with cores. Each worker
+# process has its own ReportTemplate. Jobs beyond REPORT_QUEUE_DEPTH in flight
+# get a 503, and a job taking longer than REPORT_TIMEOUT seconds gets a 504.
+# A timed-out render's worker is killed and a pool broken by a dead worker is
+# replaced on the spot (see BoundedExecutor.run_in_process).
+REPORT_WORKERS = int(os.environ.get("DEEPGYN_REPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+REPORT_QUEUE_DEPTH = int(os.environ.get("DEEPGYN_REPORT_QUEUE_DEPTH", str(4 * REPORT_WORKERS)))
+REPORT_TIMEOUT = float(os.environ.get("DEEPGYN_REPORT_TIMEOUT", "30"))
+
+# spawn, not fork: the parent has TF and executor threads that must not be forked
+report_pool = functools.partial(ProcessPoolExecutor, max_workers=max(1, REPORT_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+reports = BoundedExecutor(report_pool(), REPORT_QUEUE_DEPTH, factory=report_pool)
+
+def render_report(*args):
+    # Runs in a worker process, so the build time travels back with the PDF
+    started = time.perf_counter()
+    pdf = report_template.render(*args)
+    return pdf, time.perf_counter() - started
+
+async def build_report(*args, timeout=None, executor=None):
+    pdf, seconds = await (executor or reports).run(render_report, *args, timeout=timeout)
+    observe_stage("report_build", seconds)
+    return pdf
+
+def warm_report_pool():
+    # Start the worker processes now rather than on the first download
+    for _ in range(REPORT_WORKERS):
+        reports.pool.submit(int)
+
+def scan_report_args(row):
+    # Report inputs for a stored scan: the same Patient ID as /generate-report,
+    # dated with the scan's own date
+    details = json.loads(row["details"]) if row["details"] else {}
+    return (row["prediction"], row["confidence"], details, row["name"], row["age"], row["location"],
+            derive_patient_id(row["name"], row["age"], row["location"]), row["timestamp"][:10])
+
+def pdf_response(pdf, filename="DeepGynScan_Report.pdf"):
+    return Response(content=pdf, media_type="application/pdf",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# --- Report Cache ---
+# Rendered PDFs are stored under REPORT_CACHE_DIR as <key>.pdf, where key is a
+# SHA-256 of the template version and every report input. Identical requests
+# become file reads, and the key doubles as a strong ETag so clients holding
+# the PDF get a 304. The directory is LRU-trimmed to REPORT_CACHE_BYTES (file
+# mtimes record recency, so the order survives restarts); 0 disables it.
+# get/put run on worker threads, so the index is guarded by a lock, and a
+# cache that fails to read or write only costs a re-render, never the request.
+REPORT_CACHE_DIR = os.environ.get("DEEPGYN_REPORT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "report_cache"))
+REPORT_CACHE_BYTES = int(os.environ.get("DEEPGYN_REPORT_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+def private_dir(path):
+    # Patient PDFs live here: the directory must be ours and closed to other
+    # local users, or someone else could read them or plant files to be served
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        raise RuntimeError(f"{path} is not a directory")
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise RuntimeError(f"{path} is owned by another user; refusing to use it")
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+def report_key(*inputs):
+    payload = json.dumps([REPORT_TEMPLATE_VERSION, *inputs], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ReportCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = None
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "not_modified": 0, "misses": 0, "evictions": 0, "errors": 0}
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def _load(self):
+        # Rebuild the LRU order from what a previous run left on disk
+        private_dir(self.directory)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pdf") and entry.is_file():
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name[:-4], st.st_size))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        self.total_bytes = sum(self.entries.values())
+
+    def get(self, key):
+        # Returns the PDF bytes, read under the lock so a concurrent put can't
+        # evict the file between the lookup and the read
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            try:
+                if self.entries is None:
+                    self._load()
+                if key not in self.entries:
+                    self.stats["misses"] += 1
+                    return None
+                path = self.path(key)
+                with open(path, "rb") as f:
+                    pdf = f.read()
+                os.utime(path)
+            except (OSError, RuntimeError) as e:
+                if self.entries is not None and key in self.entries:
+                    self.total_bytes -= self.entries.pop(key)
+                self.stats["errors"] += 1
+                print(f"⚠️ Report cache read failed: {e}")
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return pdf
+
+    def put(self, key, pdf):
+        if self.max_bytes <= 0:
+            return
+        tmp = self.path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with self.lock:
+                if self.entries is None:
+                    self._load()
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+                f.write(pdf)
+            with self.lock:
+                os.replace(tmp, self.path(key))
+                self.total_bytes += len(pdf) - self.entries.pop(key, 0)
+                self.entries[key] = len(pdf)
+                while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                    old_key, size = self.entries.popitem(last=False)
+                    self.total_bytes -= size
+                    self.stats["evictions"] += 1
+                    try:
+                        os.unlink(self.path(old_key))
+                    except OSError:
+                        pass
+        except (OSError, RuntimeError) as e:
+            self.stats["errors"] += 1
+            print(f"⚠️ Report cache write failed: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def snapshot(self):
+        return {**self.stats, "entries": len(self.entries or ()), "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes, "directory": self.directory}
+
+report_cache = ReportCache(REPORT_CACHE_DIR, REPORT_CACHE_BYTES)
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+@app.get("/report-cache-stats")
+async def report_cache_stats():
+    return report_cache.snapshot()
+
+@app.post("/generate-report")
+async def generate_report(
+    prediction: str = Body(...),
+    confidence: float = Body(...),
+    details: dict = Body(...),
+    patientName: str = Body(...),
+    patientAge: int = Body(...),
+    patientLocation: str = Body(...),
+    if_none_match: Optional[str] = Header(None),
+):
+    args = (prediction, confidence, details, patientName, patientAge, patientLocation,
+            derive_patient_id(patientName, patientAge, patientLocation), date.today().isoformat())
+    key = report_key(*args)
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        report_cache.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+
+    pdf = await asyncio.to_thread(report_cache.get, key)
+    if pdf is None:
+        with reports.slot():
+            try:
+                pdf = await build_report(*args, timeout=REPORT_TIMEOUT)
+            except asyncio.TimeoutError:
+                return JSONResponse(status_code=504, content={"error": "Report rendering timed out."})
+            except Exception as e:
+                return {"error": str(e)}
+        await asyncio.to_thread(report_cache.put, key, pdf)
+    response = pdf_response(pdf)
+    response.headers.update(headers)
+    return response
+
+# --- BULK REPORT EXPORT ---
+# Renders every scan of a doctor (optionally within a date range) with the
+# same layout as /generate-report, reading rows straight from scans:
+#   format=pdf - one paginated PDF, built in an export worker process. Rows
+#                are read page by page and flowables are produced on demand,
+#                so only a handful of reports' flowables exist at any time.
+#   format=zip - one PDF per scan, rendered on the export pool and appended
+#                to a zip on disk as they complete (in scan order).
+# Exports run on their own EXPORT_WORKERS process pool, never on the one
+# behind /generate-report, so a long export can't starve interactive reports.
+# POST returns a job id; poll GET /export-reports/{id} for progress and fetch
+# the file from /download when it is done. Finished exports are kept on disk
+# for EXPORT_TTL seconds, in a directory only this user can read (see private_dir).
+# A scan whose report can't be built is left out and listed under "skipped".
+EXPORT_DIR = os.environ.get("DEEPGYN_EXPORT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports"))
+EXPORT_MAX_JOBS = int(os.environ.get("DEEPGYN_EXPORT_MAX_JOBS", "2"))
+EXPORT_TTL = float(os.environ.get("DEEPGYN_EXPORT_TTL", "3600"))
+EXPORT_WORKERS = int(os.environ.get("DEEPGYN_EXPORT_WORKERS", "1"))
+
+# Admission is already capped by EXPORT_MAX_JOBS, so the pending limit only has
+# to cover a zip job's render window
+export_pool = functools.partial(ProcessPoolExecutor, max_workers=max(1, EXPORT_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+exports_pool = BoundedExecutor(export_pool(), EXPORT_MAX_JOBS, factory=export_pool)
+
+export_jobs = {}
+
+class StreamedFlowables(list):
+    # platypus only uses len(), [0], del [0] and insert(0) on the flowable list,
+    # so topping the buffer up from a generator inside len() keeps it short
+    def __init__(self, source, low_water=64):
+        super().__init__()
+        self.source = source
+        self.low_water = low_water
+
+    def __len__(self):
+        while list.__len__(self) < self.low_water:
+            chunk = next(self.source, None)
+            if chunk is None:
+                break
+            self.extend(chunk)
+        return list.__len__(self)
+
+def render_export_pdf(db_path, email, start, end, out_path, progress_name):
+    # Spawned report workers share the server's resource tracker, which already
+    # tracks this segment, so attach without attach_segment's unregister
+    progress = shared_memory.SharedMemory(name=progress_name)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+
+    skipped = []
+
+    def flowables():
+        rendered = 0
+        for n, row in enumerate(iter_export_rows(conn, email, start, end), start=1):
+            # One malformed stored scan is reported, not allowed to fail the export
+            try:
+                elements = report_template.report_flowables(*scan_report_args(row))
+            except Exception as e:
+                skipped.append({"id": row["id"], "error": str(e)})
+            else:
+                if rendered:
+                    yield [PageBreak()]
+                yield elements
+                rendered += 1
+            struct.pack_into("q", progress.buf, 0, n)
+        if not rendered:
+            yield [Paragraph("No reports to export.", report_template.normal_style)]
+
+    try:
+        report_template.document(out_path).build(StreamedFlowables(flowables()))
+    finally:
+        conn.close()
+        progress.close()
+    return skipped
+
+async def run_export_pdf(job, email, start, end):
+    progress = shared_memory.SharedMemory(create=True, size=8)
+    struct.pack_into("q", progress.buf, 0, 0)
+    try:
+        future = asyncio.ensure_future(exports_pool.run(render_export_pdf, DB_NAME, email, start, end, job["path"], progress.name))
+        while not future.done():
+            job["done"] = struct.unpack_from("q", progress.buf, 0)[0]
+            await asyncio.wait([future], timeout=0.5)
+        job["skipped"].extend(await future)
+    finally:
+        progress.close()
+        progress.unlink()
+
+def export_entry_name(row):
+    # Patient names are client input: keep only a safe character set so an entry
+    # can never carry a path ("../", "/", "\\") out of the extraction directory
+    name = re.sub(r"[^A-Za-z0-9_-]+", "_", row["name"] or "").strip("_")[:64]
+    return f"DG-{row['id']:04d}_{name}.pdf" if name else f"DG-{row['id']:04d}.pdf"
+
+async def run_export_zip(job, email, start, end):
+    window = max(2, 2 * EXPORT_WORKERS)
+    pending = []
+    with zipfile.ZipFile(job["path"], "w", compression=zipfile.ZIP_STORED) as archive:
+        async def write_oldest():
+            row, future = pending.pop(0)
+            try:
+                pdf = await future
+            except Exception as e:
+                job["skipped"].append({"id": row["id"], "error": str(e)})
+            else:
+                await asyncio.to_thread(archive.writestr, export_entry_name(row), pdf)
+            job["done"] += 1
+
+        after_id = 0
+        while rows := await db.run(fetch_export_page, email, after_id, start, end):
+            for row in rows:
+                pending.append((row, asyncio.ensure_future(build_report(*scan_report_args(row), executor=exports_pool))))
+                if len(pending) >= window:
+                    await write_oldest()
+            after_id = rows[-1]["id"]
+        while pending:
+            await write_oldest()
+
+async def run_export(job, email, start, end):
+    job["status"] = "running"
+    try:
+        job["total"] = await db.run(count_scans, email, start, end)
+        if job["format"] == "pdf":
+            await run_export_pdf(job, email, start, end)
+        else:
+            await run_export_zip(job, email, start, end)
+        job["done"] = job["total"]
+        job["status"] = "done"
     except Exception as e:
-        return {"error": str(e)}
+        job.update(status="failed", error=str(e))
+        if os.path.exists(job["path"]):
+            os.unlink(job["path"])
+    finally:
+        job["finished"] = time.time()
+
+def expire_export_jobs():
+    now = time.time()
+    for job_id, job in list(export_jobs.items()):
+        if job.get("finished") and now - job["finished"] > EXPORT_TTL:
+            if os.path.exists(job["path"]):
+                os.unlink(job["path"])
+            del export_jobs[job_id]
+
+def export_status(job):
+    status = {k: job[k] for k in ("job_id", "status", "format", "total", "done", "error", "skipped")}
+    status["progress"] = round(job["done"] / job["total"], 4) if job["total"] else (1.0 if job["status"] == "done" else 0.0)
+    if job["status"] == "done":
+        status["download_url"] = f"/export-reports/{job['job_id']}/download"
+    return status
+
+@app.post("/export-reports")
+async def export_reports(data: ExportRequest):
+    if data.format not in ("pdf", "zip"):
+        return JSONResponse(status_code=400, content={"error": "format must be 'pdf' or 'zip'"})
+    expire_export_jobs()
+    if sum(job["status"] in ("queued", "running") for job in export_jobs.values()) >= EXPORT_MAX_JOBS:
+        raise ServerBusy()
+
+    private_dir(EXPORT_DIR)
+    job_id = uuid.uuid4().hex
+    job = {"job_id": job_id, "status": "queued", "format": data.format, "total": 0, "done": 0, "error": None, "skipped": [],
+           "path": os.path.join(EXPORT_DIR, f"{job_id}.{data.format}"), "finished": None}
+    export_jobs[job_id] = job
+    job["task"] = asyncio.create_task(run_export(job, data.doctor_email, data.start, data.end))
+    return export_status(job)
+
+@app.get("/export-reports/{job_id}")
+async def export_report_status(job_id: str):
+    job = export_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown export job."})
+    return export_status(job)
+
+@app.get("/export-reports/{job_id}/download")
+async def export_report_download(job_id: str):
+    job = export_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown export job."})
+    if job["status"] != "done":
+        return JSONResponse(status_code=409, content=export_status(job))
+    media_type = "application/pdf" if job["format"] == "pdf" else "application/zip"
+    return FileResponse(job["path"], media_type=media_type, filename=f"DeepGynScan_Reports.{job['format']}")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="DeepGynScan AI server")
+    parser.add_argument("--parity-check", metavar="IMAGE_DIR",
+                        help="check that all inference backends agree on a reference image set, then exit")
+    parser.add_argument("--inference-server", metavar="ADDRESS",
+                        help="run only the shared model process, listening on a socket path or host:port")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="concurrent forward passes in --inference-server mode")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="uvicorn HTTP workers (set DEEPGYN_INFERENCE_SERVER to share one model)")
+    args = parser.parse_args()
+
+    if args.parity_check:
+        load_model()
+        if model is None: sys.exit("Model not loaded.")
+        sys.exit(0 if check_backend_parity(args.parity_check) else 1)
+
+    if args.inference_server:
+        serve_inference(args.inference_server, args.threads)
+    elif args.workers > 1:
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=args.workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
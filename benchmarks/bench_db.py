@@ -0,0 +1,104 @@
+# Compares /save-scan and /history data access under concurrent clients:
+#   legacy - sqlite3.connect() per request, run on the event loop (pre-pool code)
+#   pooled - app.ConnectionPool (WAL, tuned pragmas, thread-local connections)
+#   write-behind - pooled, with saves grouped by app.WriteBehindQueue (ack on commit)
+#
+#   python benchmarks/bench_db.py --clients 32 --ops 200 --seed-rows 20000
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import sqlite3
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import app
+
+def legacy_save(path, row):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("INSERT INTO scans (doctor_email, name, age, location, prediction, confidence, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+    conn.commit()
+    conn.close()
+
+def legacy_history(path, email):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM scans WHERE doctor_email = ? ORDER BY id DESC", (email,))
+    rows = c.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def make_row(i):
+    return (f"doctor{i % 50}@clinic.test", f"Patient {i}", 20 + i % 50, "Coimbatore", "Normal", 0.9,
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+def seed(path, rows, journal_mode):
+    app.init_db(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    conn.executemany("INSERT INTO scans (doctor_email, name, age, location, prediction, confidence, timestamp, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     [make_row(i) + (int(time.time()),) for i in range(rows)])
+    conn.commit()
+    conn.close()
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+async def run_clients(clients, ops, op):
+    latencies = []
+
+    async def client(n):
+        for i in range(ops):
+            started = time.perf_counter()
+            await op(n * ops + i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(n) for n in range(clients)])
+    elapsed = time.perf_counter() - started
+    return {"ops_per_s": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3)}
+
+async def bench(mode, path, clients, ops):
+    if mode == "legacy":
+        async def save(i): legacy_save(path, make_row(i))
+        async def history(i): legacy_history(path, f"doctor{i % 50}@clinic.test")
+    else:
+        pool = app.ConnectionPool(path, app.DB_POOL_SIZE)
+        writer = app.WriteBehindQueue(pool, app.WRITE_BATCH_ROWS, app.WRITE_BATCH_MS, app.WRITE_QUEUE_LIMIT, "commit")
+        writer.start()
+        if mode == "write-behind":
+            async def save(i): await writer.submit(app.scan_row(*make_row(i)[:-1], time.time()))
+        else:
+            async def save(i): await pool.run(app.insert_scan, *make_row(i)[:-1], time.time())
+        async def history(i): await pool.run(app.fetch_history, f"doctor{i % 50}@clinic.test", app.HISTORY_PAGE_SIZE)
+    results = {"save": await run_clients(clients, ops, save),
+               "history": await run_clients(clients, max(1, ops // 10), history)}
+    if mode != "legacy":
+        await writer.close()
+        pool.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite save/history throughput: legacy vs pooled")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--ops", type=int, default=200, help="saves per client (history runs a tenth of that)")
+    parser.add_argument("--seed-rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    for mode, journal_mode in [("legacy", "DELETE"), ("pooled", "WAL"), ("write-behind", "WAL")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            seed(path, args.seed_rows, journal_mode)
+            results = asyncio.run(bench(mode, path, args.clients, args.ops))
+        for op, r in results.items():
+            print(f"{mode:12} {op:8} {r['ops_per_s']:10.1f} ops/s  p50 {r['p50_ms']:8.3f} ms  p95 {r['p95_ms']:8.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# End-to-end load test of a real uvicorn server, with everything generated
+# locally so runs are reproducible and comparable between commits:
+#   - a stand-in Keras CNN with the production shape (224x224x3 -> 5 classes),
+#     seeded weights, unless --model points at a real cnn_model.h5
+#   - synthetic Pap-smear-like micrographs (seeded)
+#   - a scans DB seeded with --seed-rows rows spread over 50 doctors
+# Each scenario runs closed-loop at every --concurrency level and records
+# throughput, error counts and p50/p95/p99 latency. Results are written to
+# benchmarks/results/<timestamp>-<commit>.json; --compare prints the change
+# against an earlier result file.
+#
+#   python benchmarks/bench_load.py --concurrency 1 8 32 --requests 200
+#   python benchmarks/bench_load.py --compare benchmarks/results/<old>.json
+#
+# Needs httpx (pip install httpx). Prediction and report caches are disabled
+# in the server so repeated inputs measure real work; pass --with-caches to
+# keep them.
+import os
+import sys
+import io
+import json
+import time
+import socket
+import sqlite3
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SCENARIOS = ["home", "predict", "save-scan", "history", "generate-report"]
+DOCTORS = 50
+
+def build_model(path, seed):
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(seed)
+    model = tf.keras.Sequential([
+        tf.keras.Input(shape=app.INPUT_SHAPE),
+        tf.keras.layers.Conv2D(32, 3, activation="relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(64, 3, activation="relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(128, 3, activation="relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(128, activation="relu"),
+        tf.keras.layers.Dense(len(app.classes), activation="softmax"),
+    ])
+    model.save(path)
+
+def make_micrograph(rng, size):
+    # Pink/purple background with scattered stained cells and darker nuclei
+    w, h = size
+    img = Image.new("RGB", size, tuple(int(c) for c in rng.integers([200, 150, 180], [240, 190, 220])))
+    draw = ImageDraw.Draw(img)
+    for _ in range(int(rng.integers(15, 40))):
+        x, y = rng.integers(0, w), rng.integers(0, h)
+        r = int(rng.integers(w // 40, w // 12))
+        cell = tuple(int(c) for c in rng.integers([120, 60, 120], [200, 140, 200]))
+        draw.ellipse([x - r, y - int(r * 0.8), x + r, y + int(r * 0.8)], fill=cell, outline=(90, 40, 100))
+        n = max(2, r // int(rng.integers(3, 6)))
+        draw.ellipse([x - n, y - n, x + n, y + n], fill=(60, 20, 80))
+    img = img.filter(ImageFilter.GaussianBlur(1))
+    noise = rng.normal(0, 6, (h, w, 3))
+    return Image.fromarray(np.clip(np.asarray(img, dtype=np.float32) + noise, 0, 255).astype("uint8"))
+
+def make_images(count, size, seed):
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        buf = io.BytesIO()
+        make_micrograph(rng, size).save(buf, "JPEG", quality=90)
+        images.append(buf.getvalue())
+    return images
+
+def seed_db(path, rows, seed):
+    rng = random.Random(seed)
+    app.init_db(path)
+    conn = sqlite3.connect(path)
+    started = time.time() - 365 * 86400
+    batch = []
+    for i in range(rows):
+        probs = np.random.default_rng(seed + i).dirichlet(np.ones(len(app.classes)))
+        details = dict(zip(app.classes, probs.round(6).tolist()))
+        top = app.classes[int(np.argmax(probs))]
+        batch.append(app.scan_row(f"doctor{i % DOCTORS}@clinic.test", f"Patient {i}", rng.randint(18, 80),
+                                  rng.choice(["Coimbatore", "Chennai", "Madurai", "Salem"]), app.category_map[top],
+                                  float(probs.max()), started + i * (365 * 86400 / max(1, rows)), details))
+        if len(batch) == 1000:
+            app.insert_scans(conn, batch)
+            batch = []
+    if batch:
+        app.insert_scans(conn, batch)
+    conn.close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, model_path, port, with_caches):
+    env = {**os.environ,
+           "DEEPGYN_DB": os.path.join(workdir, "scans.db"),
+           "DEEPGYN_MODEL_PATH": model_path,
+           "DEEPGYN_EXPORT_DIR": os.path.join(workdir, "exports"),
+           "DEEPGYN_REPORT_CACHE_DIR": os.path.join(workdir, "report-cache")}
+    if not with_caches:
+        env.update(DEEPGYN_PREDICTION_CACHE_SIZE="0", DEEPGYN_REPORT_CACHE_BYTES="0")
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+                               "--log-level", "warning"], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"Server exited early, see {log.name}")
+        try:
+            if httpx.get(f"{base_url}/readyz").status_code == 200:
+                return server, base_url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    sys.exit(f"Server not ready after 300 s, see {log.name}")
+
+def scenario_requests(name, images, seed):
+    # Returns a function i -> request kwargs; inputs cycle deterministically
+    rng = random.Random(seed)
+    if name == "home":
+        return lambda i: {"method": "GET", "url": "/", "headers": {"Accept-Encoding": "gzip, br"}}
+    if name == "predict":
+        return lambda i: {"method": "POST", "url": "/predict", "files": {"file": ("scan.jpg", images[i % len(images)], "image/jpeg")}}
+    if name == "save-scan":
+        return lambda i: {"method": "POST", "url": "/save-scan", "json": {
+            "doctor_email": f"doctor{i % DOCTORS}@clinic.test", "name": f"Load {i}", "age": 20 + i % 60,
+            "location": "Coimbatore", "prediction": "Normal", "confidence": 0.9}}
+    if name == "history":
+        return lambda i: {"method": "GET", "url": "/history", "params": {"email": f"doctor{i % DOCTORS}@clinic.test"}}
+    if name == "generate-report":
+        ages = [rng.randint(18, 80) for _ in range(64)]
+        return lambda i: {"method": "POST", "url": "/generate-report", "json": {
+            "prediction": "Pre-cancerous", "confidence": 0.71,
+            "details": {"im_Dyskeratotic": 0.05, "im_Koilocytotic": 0.71, "im_Metaplastic": 0.12,
+                        "im_Parabasal": 0.07, "im_Superficial-Intermediate": 0.05},
+            "patientName": f"Patient {i}", "patientAge": ages[i % len(ages)], "patientLocation": "Coimbatore"}}
+    raise ValueError(name)
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000 if samples else None
+
+async def run_scenario(base_url, make_request, concurrency, requests, warmup):
+    latencies, statuses = [], {}
+    counter = iter(range(requests + warmup))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    response = await client.request(**make_request(i))
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                if i >= warmup:
+                    latencies.append(time.perf_counter() - started)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        # Warm-up requests share the iterator, so they finish before most timed ones start
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+
+    ok = sum(n for status, n in statuses.items() if status.startswith("2"))
+    return {"concurrency": concurrency, "requests": len(latencies), "ok": ok, "statuses": statuses,
+            "elapsed_s": round(elapsed, 3), "throughput_rps": round(ok / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50), 3), "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3), "max_ms": round(max(latencies) * 1000, 3)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nvs {baseline_path} ({baseline['meta']['commit']})")
+    for r in current["results"]:
+        b = old.get((r["scenario"], r["concurrency"]))
+        if b is None:
+            continue
+        change = lambda key: (r[key] - b[key]) / b[key] * 100 if b[key] else float("nan")
+        print(f"{r['scenario']:16} c={r['concurrency']:<4} throughput {change('throughput_rps'):+7.1f}%  "
+              f"p50 {change('p50_ms'):+7.1f}%  p99 {change('p99_ms'):+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test every endpoint against generated data")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--image-size", type=int, nargs=2, default=[768, 576], metavar=("W", "H"))
+    parser.add_argument("--seed-rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--model", help="use this .h5 instead of the generated stand-in model")
+    parser.add_argument("--with-caches", action="store_true", help="leave the prediction and report caches on")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", metavar="RESULT_JSON", help="print the change against an earlier result file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="deepgyn-bench-") as workdir:
+        model_path = args.model
+        if model_path is None:
+            model_path = os.path.join(workdir, "cnn_model.h5")
+            build_model(model_path, args.seed)
+        seed_db(os.path.join(workdir, "scans.db"), args.seed_rows, args.seed)
+        images = make_images(args.images, tuple(args.image_size), args.seed)
+
+        server, base_url = start_server(workdir, model_path, free_port(), args.with_caches)
+        results = []
+        try:
+            for scenario in args.scenarios:
+                make_request = scenario_requests(scenario, images, args.seed)
+                for concurrency in args.concurrency:
+                    r = asyncio.run(run_scenario(base_url, make_request, concurrency, args.requests, args.warmup))
+                    results.append({"scenario": scenario, **r})
+                    print(f"{scenario:16} c={concurrency:<4} {r['throughput_rps']:9.1f} req/s  p50 {r['p50_ms']:9.2f} ms  "
+                          f"p95 {r['p95_ms']:9.2f} ms  p99 {r['p99_ms']:9.2f} ms  {r['statuses']}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    commit = git_commit()
+    report = {
+        "meta": {"commit": commit, "timestamp": datetime.now().isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "model": args.model or "generated", "args": vars(args)},
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# Reports per second for /generate-report:
+#   legacy   - the original per-request build (styles, logo, tables rebuilt,
+#              written to a NamedTemporaryFile)
+#   template - app.ReportTemplate (static parts prebuilt, rendered in memory)
+#   pool     - template renders fanned out over app.reports (DEEPGYN_REPORT_WORKERS processes)
+#
+#   python benchmarks/bench_reports.py --reports 200
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import app
+from app import category_map
+from reportlab.lib.pagesizes import A4
+from reportlab.lib import colors
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.graphics.shapes import Drawing, Rect, String
+
+SAMPLE = {
+    "prediction": "Pre-cancerous",
+    "confidence": 0.8731,
+    "details": {"im_Dyskeratotic": 0.05, "im_Koilocytotic": 0.8731, "im_Metaplastic": 0.04,
+                "im_Parabasal": 0.02, "im_Superficial-Intermediate": 0.0169},
+    "patientName": "Jane Doe",
+    "patientAge": 42,
+    "patientLocation": "Coimbatore",
+}
+
+def legacy_report(prediction, confidence, details, patientName, patientAge, patientLocation):
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+
+    # --- PDF SETUP ---
+    doc = SimpleDocTemplate(temp_file.name, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
+    elements = []
+    styles = getSampleStyleSheet()
+
+    # Custom Styles
+    title_style = ParagraphStyle(name='Title', parent=styles['Heading1'], alignment=1, fontSize=18, spaceAfter=20)
+    normal_style = styles['Normal']
+    header_text_style = ParagraphStyle(name='Header', parent=styles['Normal'], alignment=2, fontSize=9)
+
+    # --- 1. HEADER (Logo Placeholder + Lab Info) ---
+    # Drawing a simple "Logo" using graphics since we can't rely on external images in a single file
+    d = Drawing(100, 50)
+    d.add(Rect(0, 0, 100, 50, fillColor=colors.HexColor('#00d2ff'), strokeColor=None))
+    d.add(String(10, 20, "DEEPGYN", fontSize=14, fillColor=colors.white))
+    d.add(String(10, 10, "SCAN AI", fontSize=8, fillColor=colors.white))
+
+    # Table for Header (Logo Left, Text Right)
+    header_data = [
+        [d, Paragraph("<b>DEEPGYNSCAN DIAGNOSTICS LAB</b><br/>KPRIET, Coimbatore<br/>Licence No: 2764<br/>Phone: +91 8072568527", header_text_style)]
+    ]
+    header_table = Table(header_data, colWidths=[120, 400])
+    header_table.setStyle(TableStyle([
+        ('VALIGN', (0,0), (-1,-1), 'TOP'),
+        ('ALIGN', (1,0), (1,0), 'RIGHT'),
+    ]))
+    elements.append(header_table)
+    elements.append(Spacer(1, 20))
+
+    # --- 2. TITLE ---
+    elements.append(Paragraph("CERVICAL CYTOLOGY AI ANALYSIS", title_style))
+    elements.append(Spacer(1, 10))
+
+    # --- 3. PATIENT DEMOGRAPHICS (Grid) ---
+    patient_data = [
+        ["Patient Name:", patientName, "Patient ID:", "DG-" + str(random.randint(1000,9999))],
+        ["Age / Gender:", f"{patientAge} Years / Female", "Date:", datetime.now().strftime("%Y-%m-%d")],
+        ["Referred By:", "DeepGynScan AI", "Location:", patientLocation]
+    ]
+
+    t_patient = Table(patient_data, colWidths=[90, 180, 90, 170])
+    t_patient.setStyle(TableStyle([
+        ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
+        ('BACKGROUND', (0,0), (0,-1), colors.whitesmoke),
+        ('BACKGROUND', (2,0), (2,-1), colors.whitesmoke),
+        ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,0), (-1,-1), 10),
+        ('PADDING', (0,0), (-1,-1), 8),
+        ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
+        ('FONTNAME', (2,0), (2,-1), 'Helvetica-Bold'),
+    ]))
+    elements.append(t_patient)
+    elements.append(Spacer(1, 25))
+
+    # --- 4. DIAGNOSIS RESULT ---
+    # Determine Color based on result
+    res_color = "green"
+    if "High" in prediction: res_color = "red"
+    elif "Pre" in prediction: res_color = "orange"
+
+    elements.append(Paragraph("<b>CLINICAL IMPRESSION:</b>", styles['Heading3']))
+    result_html = f"<font size='14' color='{res_color}'><b>{prediction}</b></font>"
+    elements.append(Paragraph(result_html, styles['Normal']))
+    elements.append(Spacer(1, 10))
+    elements.append(Paragraph(f"<b>AI Model Confidence:</b> {confidence*100:.2f}%", styles['Normal']))
+    elements.append(Spacer(1, 20))
+
+    # --- 5. CONFIDENCE BREAKDOWN TABLE ---
+    elements.append(Paragraph("<b>Detailed Class Probabilities:</b>", styles['Heading4']))
+
+    # Header for the table
+    table_data = [["Class Name", "Risk Category", "Probability Score"]]
+
+    # Sort details by score
+    sorted_details = sorted(details.items(), key=lambda x: x[1], reverse=True)
+
+    for cls, score in sorted_details:
+        mapped_cls_category = category_map.get(cls, "Unknown")
+        # Drawing a small bar for visualization inside table
+        bar_width = int(score * 100)
+        bar_color = colors.green
+        if "High" in mapped_cls_category: bar_color = colors.red
+        elif "Pre" in mapped_cls_category: bar_color = colors.orange
+
+        # Simple text representation of bar for robustness
+        prob_text = f"{score*100:.2f}%"
+        table_data.append([cls.replace("im_", ""), mapped_cls_category, prob_text])
+
+    t_conf = Table(table_data, colWidths=[200, 200, 100])
+    t_conf.setStyle(TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#00d2ff')),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.white),
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,0), (-1,0), 10),
+        ('BOTTOMPADDING', (0,0), (-1,0), 10),
+        ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey),
+        ('ROWBACKGROUNDS', (0,1), (-1,-1), [colors.whitesmoke, colors.white]),
+        ('PADDING', (0,0), (-1,-1), 8),
+    ]))
+    elements.append(t_conf)
+    elements.append(Spacer(1, 40))
+
+    # --- 6. FOOTER / SIGNATURE ---
+    sig_data = [
+        ["_______________________", "_______________________"],
+        ["AI System Generated", "Chief Pathologist Signature"]
+    ]
+    t_sig = Table(sig_data, colWidths=[250, 250])
+    t_sig.setStyle(TableStyle([
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTSIZE', (0,0), (-1,-1), 8),
+        ('TEXTCOLOR', (0,0), (-1,-1), colors.grey),
+    ]))
+    elements.append(t_sig)
+    elements.append(Spacer(1, 10))
+
+    disclaimer = "<b>DISCLAIMER:</b> This report is generated by an Artificial Intelligence system (DeepGynScan) and serves as a preliminary screening tool. It does not replace a professional medical diagnosis. All results must be clinically correlated and verified by a certified pathologist."
+    elements.append(Paragraph(disclaimer, ParagraphStyle(name='Footer', parent=styles['Normal'], fontSize=7, textColor=colors.grey, alignment=4))) # Justify
+
+    # BUILD PDF
+    doc.build(elements)
+    with open(temp_file.name, "rb") as f:
+        pdf = f.read()
+    os.unlink(temp_file.name)  # the original never deleted it
+    return pdf
+
+def template_report(prediction, confidence, details, patientName, patientAge, patientLocation):
+    return app.report_template.render(prediction, confidence, details, patientName, patientAge, patientLocation)
+
+def bench(fn, reports):
+    fn(**SAMPLE)  # warm-up: font loading, module-level caches
+    started = time.perf_counter()
+    for _ in range(reports):
+        fn(**SAMPLE)
+    elapsed = time.perf_counter() - started
+    return reports / elapsed, elapsed / reports * 1000
+
+def bench_pool(reports):
+    args = [SAMPLE[k] for k in ("prediction", "confidence", "details", "patientName", "patientAge", "patientLocation")]
+    pool = app.reports.pool
+    list(pool.map(app.render_report, *zip(*[args] * app.REPORT_WORKERS)))  # warm-up: spawn workers
+    started = time.perf_counter()
+    list(pool.map(app.render_report, *zip(*[args] * reports)))
+    elapsed = time.perf_counter() - started
+    return reports / elapsed, elapsed / reports * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="ReportLab report throughput: legacy vs template")
+    parser.add_argument("--reports", type=int, default=200)
+    args = parser.parse_args()
+    for name, fn in [("legacy", legacy_report), ("template", template_report)]:
+        rate, per_report = bench(fn, args.reports)
+        print(f"{name:9} {rate:8.1f} reports/s  {per_report:7.2f} ms/report")
+    rate, per_report = bench_pool(args.reports)
+    print(f"{'pool':9} {rate:8.1f} reports/s  {per_report:7.2f} ms/report  ({app.REPORT_WORKERS} workers)")
+
+if __name__ == "__main__":
+    main()